@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+"""
+Builds the outputs for many input text files in one run. The files are
+spread over a pool of worker processes and a summary of how each file
+fared is printed at the end.
+
+A run manifest, a JSON lines file, can record the hash of each input and
+how each of its branches fared as each file completes. A run which was
+killed partway is resumed with --resume; inputs the manifest records as
+built, whose outputs are all still there, are skipped. Inputs with the
+same content as another are built only once.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+import prepInBldOut as pIBO
+
+
+# Name of the run manifest in the output directory, when --resume is
+# given without --manifest.
+_RUN_MANIFEST = 'run.manifest.jsonl'
+# Bytes of an input hashed at a time.
+_HASH_CHUNK = 1 << 20
+
+
+def expandInputs(in_paths):
+    """
+    Expands the input paths into a list of input files. Each path may
+    be a file, a directory (its '*.txt' files are taken) or a glob.
+    Paths which match nothing are kept so they're reported as failed.
+    """
+
+    in_files = []
+    for in_path in in_paths:
+        if os.path.isdir(in_path):
+            in_files.extend(sorted(glob.glob(os.path.join(in_path,
+                                                          '*.txt'))))
+        elif os.path.exists(in_path):
+            in_files.append(in_path)
+        else:
+            matched = sorted(glob.glob(in_path))
+            in_files.extend(matched if matched else [in_path])
+
+    return in_files
+
+def convFile(in_filename, clargs):
+    """
+    Builds the outputs for a single input file. Runs in the worker
+    processes. Returns a dict summarising the run along with the
+    captured stdout and stderr of the run.
+    """
+
+    file_args = argparse.Namespace(**vars(clargs))
+    file_args.in_filename = in_filename
+    built, status, out, err = pIBO.runCaptured(pIBO.buildFile, file_args)
+
+    built = built if built is not None else []
+    failed = [br_name for br_name, out_fname in built if out_fname is None]
+    misaligned = [out_fname for br_name, out_fname in built if out_fname
+                  is not None and out_fname.endswith('-Misalign')]
+    if status != 0 or failed:
+        state = 'failed'
+    elif misaligned:
+        state = 'misaligned'
+    else:
+        state = 'ok'
+
+    return {'in_filename': in_filename, 'state': state, 'exit': status,
+            'branches': len(built), 'failed': failed,
+            'misaligned': misaligned, 'built': built, 'stdout': out,
+            'stderr': err}
+
+def hashFile(in_filename):
+    """
+    Returns the SHA-1 of the content of a file, in hex.
+    """
+
+    file_hash = hashlib.sha1()
+    in_file = open(in_filename, 'rb')
+    try:
+        for chunk in iter(lambda: in_file.read(_HASH_CHUNK), ''):
+            file_hash.update(chunk)
+    finally:
+        in_file.close()
+    return file_hash.hexdigest()
+
+def runKey(clargs):
+    """
+    Returns a hash of the options which change what a run writes, so
+    inputs built with other options aren't taken as done.
+    """
+
+    return hashlib.sha1(repr((pIBO._MANIFEST_VERSION,) +
+                    pIBO.outputKey(clargs) + (clargs.nowritecsv,
+                    os.path.abspath(clargs.outdir)))).hexdigest()
+
+def loadRunManifest(man_fname):
+    """
+    Reads a run manifest. Returns a list of its records, in the order
+    they were written. A missing manifest has none; a line cut short by
+    a run killed while writing it is left out.
+    """
+
+    records = []
+    try:
+        man_file = open(man_fname, 'r')
+    except IOError:
+        return records
+    try:
+        for line in man_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+    finally:
+        man_file.close()
+    return records
+
+def openRunManifest(man_fname):
+    """
+    Opens a run manifest for appending. A last line cut short by a
+    killed run is ended first, so the next record starts a line of its
+    own.
+    """
+
+    man_file = open(man_fname, 'a+')
+    man_file.seek(0, os.SEEK_END)
+    if man_file.tell():
+        man_file.seek(-1, os.SEEK_END)
+        if man_file.read(1) != '\n':
+            man_file.write('\n')
+    return man_file
+
+def appendRecord(man_file, record):
+    """
+    Appends a record to a run manifest opened for appending, and syncs
+    it to disk so it survives the run being killed.
+    """
+
+    man_file.write(json.dumps(record, sort_keys=True) + '\n')
+    man_file.flush()
+    os.fsync(man_file.fileno())
+
+def isComplete(record, clargs):
+    """
+    Whether a record is of an input built without failures, whose
+    outputs are all still there.
+    """
+
+    if record.get('state') not in ('ok', 'misaligned'):
+        return False
+    if not pIBO.writesFiles(clargs):
+        return True
+    for br_name, out_fname in record.get('built', []):
+        for out_file in pIBO.outPaths(clargs.outdir, str(out_fname),
+                                      clargs):
+            if not os.path.isfile(out_file):
+                return False
+    return True
+
+def planRun(in_files, clargs, records):
+    """
+    Works out what to do with each input file of a run with a manifest.
+    Returns a list with a dict per input of its path, size, modification
+    time, hash, and state; None for inputs to be built, 'skipped' for
+    those built by an earlier run, 'duplicate' for those with the same
+    content as an earlier input, which is named in duplicate_of.
+    Arguments:
+            in_files: The input files.
+            clargs: A argparse.Namespace object with the command line
+                    arguments
+            records: Records of the run manifest; inputs are only
+                    skipped when clargs.resume is set.
+    """
+
+    run_key = runKey(clargs)
+    # Hashes of inputs unchanged since they were recorded aren't worked
+    # out again.
+    stamps = {}
+    done = {}
+    for record in records:
+        stamps[(record.get('path'), record.get('size'),
+                record.get('mtime'))] = record.get('hash')
+        if record.get('options') == run_key and record.get('state') not in (
+                'duplicate', 'skipped'):
+            done[record.get('hash')] = record
+
+    plan = []
+    first = {}
+    for in_filename in in_files:
+        entry = {'in_filename': in_filename, 'path': None, 'hash': None,
+                 'state': None}
+        plan.append(entry)
+        try:
+            stat = os.stat(in_filename)
+            path = os.path.abspath(in_filename)
+            stamp = (path, stat.st_size, stat.st_mtime)
+            file_hash = stamps.get(stamp) or hashFile(in_filename)
+        except (IOError, OSError):
+            # Built anyway, so it's reported as failed.
+            continue
+        entry.update(path=path, size=stat.st_size, mtime=stat.st_mtime,
+                     hash=file_hash)
+        if file_hash in first:
+            entry.update(state='duplicate', duplicate_of=first[file_hash])
+            continue
+        first[file_hash] = in_filename
+        record = done.get(file_hash)
+        if clargs.resume and record is not None and isComplete(record,
+                                                               clargs):
+            entry.update(state='skipped', record=record)
+    return plan
+
+def _convFileStar(args):
+    """
+    Unpacks the arguments for convFile. Pool.imap passes one argument.
+    """
+
+    return convFile(*args)
+
+def batchBuild(clargs):
+    """
+    Builds outputs for all the input files, clargs.jobs files at a time.
+    The output of each file is printed in input order as it completes.
+    Returns the list of summaries, one per input file.
+    Arguments:
+            clargs: A argparse.Namespace object with the command line
+                    arguments
+    """
+
+    in_files = expandInputs(clargs.in_paths)
+    man_fname = runManifestPath(clargs)
+    if man_fname is None:
+        plan = [{'in_filename': in_filename, 'state': None} for
+                in_filename in in_files]
+        man_file = None
+    else:
+        try:
+            plan = planRun(in_files, clargs, loadRunManifest(man_fname))
+            pIBO.makeOutDir(os.path.dirname(man_fname) or '.')
+            man_file = openRunManifest(man_fname)
+        except pIBO.OutputError as err:
+            sys.stderr.write('%s\n' % err)
+            sys.exit(err.status)
+        except IOError as ioe:
+            sys.stderr.write('IO ERROR (%d): %s: %s\n' % (ioe.errno,
+                            ioe.strerror, man_fname))
+            sys.exit(1)
+    work = [(entry['in_filename'], clargs) for entry in plan if
+            entry['state'] is None]
+
+    if clargs.jobs == 1 or len(work) <= 1:
+        results = itertools.imap(_convFileStar, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(clargs.jobs)
+        results = pool.imap(_convFileStar, work, chunksize=1)
+
+    summary = []
+    try:
+        # Results come in the order of the inputs built; the inputs not
+        # built are summarised in between.
+        for entry in plan:
+            if entry['state'] is None:
+                res = results.next()
+            else:
+                res = _notBuilt(entry)
+            if not clargs.quiet:
+                sys.stdout.write(res.pop('stdout'))
+                sys.stderr.write(res.pop('stderr'))
+            else:
+                res.pop('stdout')
+                res.pop('stderr')
+            if man_file is not None and entry.get('hash') is not None and (
+                    res['state'] != 'skipped'):
+                appendRecord(man_file, _runRecord(entry, res, clargs))
+            summary.append(res)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if man_file is not None:
+            man_file.close()
+
+    return summary
+
+def runManifestPath(clargs):
+    """
+    Path of the run manifest; None if the run doesn't keep one.
+    """
+
+    if clargs.manifest:
+        return clargs.manifest
+    if clargs.resume:
+        return os.path.join(clargs.outdir, _RUN_MANIFEST)
+    return None
+
+def _notBuilt(entry):
+    """
+    The summary of an input which isn't built; skipped or a duplicate.
+    """
+
+    res = {'in_filename': entry['in_filename'], 'state': entry['state'],
+           'exit': 0, 'branches': 0, 'failed': [], 'misaligned': [],
+           'built': [], 'stdout': '', 'stderr': ''}
+    if entry['state'] == 'skipped':
+        record = entry['record']
+        res.update(branches=len(record.get('built', [])),
+                   misaligned=record.get('misaligned', []),
+                   built=record.get('built', []))
+    else:
+        res['duplicate_of'] = entry['duplicate_of']
+    return res
+
+def _runRecord(entry, res, clargs):
+    """
+    The record of an input for the run manifest.
+    """
+
+    record = {'path': entry['path'], 'size': entry['size'],
+              'mtime': entry['mtime'], 'hash': entry['hash'],
+              'options': runKey(clargs), 'state': res['state'],
+              'exit': res['exit'], 'built': res['built'],
+              'failed': res['failed'], 'misaligned': res['misaligned'],
+              'time': time.time()}
+    if 'duplicate_of' in res:
+        record['duplicate_of'] = res['duplicate_of']
+    return record
+
+def printSummary(summary):
+    """
+    Prints one line per input file and the counts of each outcome.
+    """
+
+    print '\nSUMMARY'
+    for res in summary:
+        if res['state'] == 'duplicate':
+            print '%-10s %s (same as %s)' % (res['state'].upper(),
+                    res['in_filename'], res['duplicate_of'])
+            continue
+        print '%-10s %s (branches: %d, failed: %d, misaligned: %d)' % (
+                res['state'].upper(), res['in_filename'], res['branches'],
+                len(res['failed']), len(res['misaligned']))
+    counts = dict((state, 0) for state in ('ok', 'misaligned', 'failed',
+                                           'skipped', 'duplicate'))
+    for res in summary:
+        counts[res['state']] += 1
+    line = 'Files: %d, ok: %d, misaligned: %d, failed: %d' % (len(summary),
+            counts['ok'], counts['misaligned'], counts['failed'])
+    # Only runs with a manifest skip inputs.
+    if counts['skipped'] or counts['duplicate']:
+        line += ', skipped: %d, duplicate: %d' % (counts['skipped'],
+                                                   counts['duplicate'])
+    print line
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('in_paths', nargs='+',
+            help='Input text files, directories holding them or globs.')
+
+    parser.add_argument('-j', '--jobs', type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes. Defaults to the number of'
+            ' cores.')
+
+    parser.add_argument('-q', '--quiet',
+            help="Don't print the output of each file, only the summary.",
+            action='store_true', default=False)
+
+    parser.add_argument('-o', '--summary',
+            help='Also write the summary as JSON to this file.')
+
+    parser.add_argument('--manifest',
+            help='Run manifest to record the hash of each input and how'
+            ' its branches fared in, a JSON object per line appended as'
+            ' each file completes. Inputs with the same content as'
+            ' another are built once.')
+
+    parser.add_argument('--resume',
+            help='Skip the inputs the run manifest records as built with'
+            ' the same options, whose outputs are still there. The'
+            ' manifest defaults to %s in the output directory.' %
+            _RUN_MANIFEST, action='store_true', default=False)
+
+    pIBO.addOutputArgs(parser)
+
+    clargs = parser.parse_args()
+    if clargs.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    summary = batchBuild(clargs)
+    printSummary(summary)
+
+    if clargs.summary:
+        try:
+            summ_file = open(clargs.summary, 'w')
+            try:
+                json.dump(summary, summ_file, indent=2)
+            finally:
+                summ_file.close()
+        except IOError as ioe:
+            sys.stderr.write('IO ERROR (%d): %s: %s\n' %
+                            (ioe.errno, ioe.strerror, clargs.summary))
+            sys.exit(1)
+
+    if [res for res in summary if res['state'] == 'failed']:
+        sys.exit(1)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
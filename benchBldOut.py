@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Benchmarks the stages of building the outputs. Each stage is run over
+every input file in a fresh worker process so that the peak memory of
+one stage doesn't hide that of the next. Throughput is reported as
+students and megabytes of input per second. Results can be written as
+JSON and compared against those of an earlier run.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import resource
+import multiprocessing
+import extractData as exDt
+import prepInBldOut as pIBO
+import batchBldOut
+import genSheets
+
+
+STAGES = ('split', 'header', 'scan', 'marks', 'parse', 'write', 'build')
+
+
+class Timer(object):
+    """
+    Adds up the time spent between calls to start and stop.
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self._start = None
+
+    def start(self):
+        self._start = time.time()
+
+    def stop(self):
+        self.seconds += time.time() - self._start
+
+
+def _branches(in_filename, use_map=False):
+    """
+    Yields the exam pattern and content of each branch of a file, read
+    through a memory map if use_map.
+    """
+
+    in_file = open(in_filename, 'rb' if use_map else 'rU')
+    try:
+        if use_map:
+            examPat = pIBO.mapExPat(in_file)
+        else:
+            examPat, in_lines = pIBO.sniffExPat(in_file)
+        br_re = pIBO.br08_re if examPat == '2008' else pIBO.br12_re
+        if use_map:
+            branches = pIBO.mapBranches(in_file, examPat, br_re)
+        else:
+            branches = pIBO.splitBranches(in_lines, br_re)
+        for br_name, br_content in branches:
+            yield examPat, br_content
+    finally:
+        in_file.close()
+
+def _stageSplit(in_filename, clargs, timer):
+    """
+    Reading the file and splitting it by branch.
+    """
+
+    timer.start()
+    for examPat, br_content in _branches(in_filename,
+                                         getattr(clargs, 'mmap', False)):
+        pass
+    timer.stop()
+
+def _stageHeader(in_filename, clargs, timer):
+    """
+    Sniffing the header fields of every branch.
+    """
+
+    for examPat, br_content in _branches(in_filename):
+        timer.start()
+        exDt.sniffHeader(br_content, examPat)
+        timer.stop()
+
+def _stageScan(in_filename, clargs, timer):
+    """
+    The single pass for the PRNs, totals and mark lines of every branch.
+    """
+
+    for examPat, br_content in _branches(in_filename):
+        timer.start()
+        exDt.scanContent(br_content, examPat, ('prn', 'total', 'subjDict',
+                                               'markLines'))
+        timer.stop()
+
+def _stageMarks(in_filename, clargs, timer):
+    """
+    Extracting the subject marks from the mark lines of every branch.
+    """
+
+    for examPat, br_content in _branches(in_filename):
+        scanned = exDt.scanContent(br_content, examPat, ('prn', 'subjDict',
+                                                'markLines', 'markStarts'))
+        subjects = exDt._groupSubjects(scanned['subjDict'], examPat)
+        if getattr(clargs, 'columnar', False):
+            getMarksFunc = exDt.getSubjMarkArray
+        else:
+            getMarksFunc = exDt.getSubjMark
+        timer.start()
+        getMarksFunc(scanned['markLines'], subjects, len(scanned['prn']),
+                    examPat, starts=scanned['markStarts'])
+        timer.stop()
+
+def _stageParse(in_filename, clargs, timer):
+    """
+    Building the Branch of every branch; all of the extraction.
+    """
+
+    for examPat, br_content in _branches(in_filename):
+        timer.start()
+        exDt.parseBranch(br_content, examPat,
+                        getMarks=(clargs.nowritesubj == False),
+                        columnar=getattr(clargs, 'columnar', False),
+                        catalog=pIBO.getCatalog(clargs))
+        timer.stop()
+
+def _stageWrite(in_filename, clargs, timer):
+    """
+    Writing the csv file of every branch.
+    """
+
+    outDir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for br_idx, (examPat, br_content) in enumerate(
+                                        _branches(in_filename)):
+            br = exDt.parseBranch(br_content, examPat,
+                        getMarks=(clargs.nowritesubj == False),
+                        columnar=getattr(clargs, 'columnar', False))
+            if not br.prn:
+                continue
+            while len(br.totalMarks) < len(br.prn):
+                br.totalMarks.append((float('NaN'), float('NaN')))
+            if getattr(clargs, 'columnar', False):
+                br.totalArr, br.graceArr = exDt.getTotalArrays(
+                                                        br.totalMarks)
+            timer.start()
+            pIBO.writeOut(br, clargs, 'branch%d' % br_idx, outDir)
+            timer.stop()
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+
+def _stageBuild(in_filename, clargs, timer):
+    """
+    The whole of the conversion of the file, output directory included.
+    """
+
+    outDir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        file_args = argparse.Namespace(**vars(clargs))
+        file_args.outdir = os.path.join(outDir, 'outCSV')
+        timer.start()
+        pIBO.convert(in_filename, file_args)
+        timer.stop()
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+
+_STAGE_FUNCS = {'split': _stageSplit, 'header': _stageHeader,
+                'scan': _stageScan, 'marks': _stageMarks,
+                'parse': _stageParse, 'write': _stageWrite,
+                'build': _stageBuild}
+
+
+def runStage(stage, in_filename, clargs):
+    """
+    Runs a stage over a file. Runs in a worker process of its own.
+    Returns the seconds spent in the stage and the peak resident memory
+    of the worker in kilobytes.
+    """
+
+    timer = Timer()
+    _STAGE_FUNCS[stage](in_filename, clargs, timer)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return timer.seconds, peak_rss
+
+def _runStageStar(args):
+    """
+    Unpacks the arguments for runStage. Pool.map passes one argument.
+    """
+
+    return runStage(*args)
+
+def countStudents(in_filename):
+    """
+    Number of students, PRNs, in a file.
+    """
+
+    return sum(len(exDt.scanContent(br_content, examPat, ('prn',))['prn'])
+                for examPat, br_content in _branches(in_filename))
+
+def benchFile(in_filename, clargs):
+    """
+    Benchmarks the stages in clargs.stages over a file. Every repeat of
+    every stage gets a fresh worker process; the fastest repeat is kept.
+    Returns a list of results, one per stage.
+    """
+
+    size_mb = os.path.getsize(in_filename) / 1e6
+    students = countStudents(in_filename)
+    in_file = open(in_filename, 'rU')
+    try:
+        examPat = pIBO.sniffExPat(in_file)[0]
+    finally:
+        in_file.close()
+
+    results = []
+    for stage in clargs.stages:
+        runs = []
+        for rep in range(clargs.repeat):
+            pool = multiprocessing.Pool(1)
+            try:
+                runs.append(pool.map(_runStageStar,
+                                    [(stage, in_filename, clargs)])[0])
+            finally:
+                pool.close()
+                pool.join()
+        seconds = min(run[0] for run in runs)
+        peak_rss = max(run[1] for run in runs)
+        res = {'file': os.path.basename(in_filename), 'examPat': examPat,
+               'stage': stage, 'students': students, 'size_mb': size_mb,
+               'seconds': seconds, 'peak_rss_kb': peak_rss,
+               'students_per_sec': students / seconds if seconds else None,
+               'mb_per_sec': size_mb / seconds if seconds else None}
+        results.append(res)
+        printResult(res)
+
+    return results
+
+def printResult(res):
+    """
+    Prints one line for the result of a stage.
+    """
+
+    print '%-24s %-7s %8d students %8.1f MB %9.3f s %11s st/s %8s MB/s' \
+            ' %9d KB' % (res['file'], res['stage'], res['students'],
+            res['size_mb'], res['seconds'],
+            '%.0f' % res['students_per_sec'] if res['seconds'] else '-',
+            '%.2f' % res['mb_per_sec'] if res['seconds'] else '-',
+            res['peak_rss_kb'])
+    sys.stdout.flush()
+
+def compareResults(old, new):
+    """
+    Prints the speedup of each stage of each file found in both runs.
+    """
+
+    old_res = dict(((res['file'], res['stage']), res)
+                   for res in old['results'])
+    print '\nCOMPARISON (old seconds / new seconds)'
+    for res in new['results']:
+        prev = old_res.get((res['file'], res['stage']))
+        if prev is None or not res['seconds']:
+            continue
+        print '%-24s %-7s %9.3f s -> %9.3f s  x%.2f  RSS %d -> %d KB' % (
+                res['file'], res['stage'], prev['seconds'], res['seconds'],
+                prev['seconds'] / res['seconds'], prev['peak_rss_kb'],
+                res['peak_rss_kb'])
+
+def genInputs(clargs, genDir):
+    """
+    Writes synthetic result sheets of the sizes in clargs.gen to genDir.
+    Returns their paths.
+    """
+
+    patterns = ['2008', '2012'] if clargs.pattern == 'both' else \
+                [clargs.pattern]
+    in_files = []
+    for students in clargs.gen:
+        for examPat in patterns:
+            in_filename = os.path.join(genDir, 'gen-%s-%d.txt' % (examPat,
+                                                                students))
+            if not os.path.exists(in_filename):
+                genSheets.genFile(in_filename, examPat, students,
+                                seed=clargs.seed)
+            in_files.append(in_filename)
+
+    return in_files
+
+def _sizes(arg):
+    """
+    Parses a comma separated list of sizes like '1k,10k,1m'.
+    """
+
+    sizes = []
+    for size in arg.split(','):
+        size = size.strip().lower()
+        mult = {'k': 1000, 'm': 1000000}.get(size[-1:], 1)
+        try:
+            sizes.append(int(size.rstrip('km')) * mult)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad size: %s' % size)
+    return sizes
+
+def _stages(arg):
+    """
+    Parses a comma separated list of stages.
+    """
+
+    stages = [stage.strip() for stage in arg.split(',')]
+    for stage in stages:
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError('unknown stage: %s' % stage)
+    return stages
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('in_paths', nargs='*',
+            help='Input text files, directories holding them or globs.')
+
+    parser.add_argument('-g', '--gen', type=_sizes, default=[],
+            help='Also benchmark synthetic sheets with these numbers of'
+            ' students, like 1k,10k,100k,1m.')
+
+    parser.add_argument('-t', '--pattern', choices=('2008', '2012', 'both'),
+            default='both', help='Exam pattern of the synthetic sheets.')
+
+    parser.add_argument('--gendir',
+            help='Directory to keep the synthetic sheets in so later runs'
+            ' reuse them. A temporary directory is used otherwise.')
+
+    parser.add_argument('--seed', type=int, default=0,
+            help='Seed for the synthetic sheets.')
+
+    parser.add_argument('--stages', type=_stages, default=list(STAGES),
+            help='Comma separated stages to run. Any of %s.' %
+            ','.join(STAGES))
+
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+            help='Runs of each stage; the fastest is reported.')
+
+    parser.add_argument('-o', '--output',
+            help='Write the results as JSON to this file.')
+
+    parser.add_argument('--compare',
+            help='JSON results of an earlier run to compare against.')
+
+    pIBO.addOutputArgs(parser)
+
+    clargs = parser.parse_args()
+    clargs.brjobs = 1
+    if not clargs.in_paths and not clargs.gen:
+        parser.error('give input files or synthetic sizes with --gen')
+    if clargs.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    in_files = batchBldOut.expandInputs(clargs.in_paths)
+    genDir = clargs.gendir or tempfile.mkdtemp(prefix='bench-gen-')
+    try:
+        if clargs.gen:
+            if not os.path.isdir(genDir):
+                os.makedirs(genDir)
+            in_files.extend(genInputs(clargs, genDir))
+
+        results = []
+        for in_filename in in_files:
+            results.extend(benchFile(in_filename, clargs))
+    finally:
+        if not clargs.gendir:
+            shutil.rmtree(genDir, ignore_errors=True)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'options': dict((key, val) for key, val in vars(clargs).items()
+                              if key not in ('in_paths', 'output',
+                                             'compare')),
+              'results': results}
+
+    if clargs.compare:
+        try:
+            old_file = open(clargs.compare, 'r')
+            try:
+                compareResults(json.load(old_file), report)
+            finally:
+                old_file.close()
+        except (IOError, ValueError) as err:
+            sys.stderr.write('ERROR: Could not read %s: %s\n' %
+                            (clargs.compare, err))
+
+    if clargs.output:
+        try:
+            out_file = open(clargs.output, 'w')
+            try:
+                json.dump(report, out_file, indent=2, sort_keys=True)
+            finally:
+                out_file.close()
+        except IOError as ioe:
+            sys.stderr.write('IO ERROR (%d): %s: %s\n' %
+                            (ioe.errno, ioe.strerror, clargs.output))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
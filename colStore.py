@@ -0,0 +1,292 @@
+"""
+Typed columnar outputs. Besides the csv file each branch may be written
+as a NumPy .npz file or a Parquet file. The files of a run make up one
+dataset partitioned by college, exam pattern, year, branch and exam
+date, laid out as key=value directories the way Parquet readers expect.
+Each format has a dataset of its own in the output directory:
+
+    outCSV/npz/college=COLNAME/examPat=2008/year=BE/branch=CIVI/
+            exDate=2015MAY/COLNAME-2008-BE-CIVI-2015MAY.npz
+
+Marks are kept as numbers with missing marks as NaN in .npz files and
+as nulls in Parquet files, so readers needn't infer the types again.
+A .npz file holds a matrix of marks with a column per head of each
+subject. A Parquet file is in long form, a row per head of each subject
+of each student, so all the files of a Parquet dataset have one schema
+and can be read together.
+"""
+
+import os
+import re
+import json
+import thread
+
+# NumPy is needed for both formats; pyarrow only for Parquet.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# Keys the dataset is partitioned by, in the order of the directories.
+PARTITION_KEYS = ('college', 'examPat', 'year', 'branch', 'exDate')
+# Output file names are College-ExamPattern-Year-Branch-ExamDate with
+# -Misalign on the end for misaligned branches. The branch is matched
+# last as its abbreviation may have a '-' in it.
+_out_fname_re = re.compile(r'^([A-Z]+)-([0-9]{4}|UNKN)-([A-Z]+)-(.+)-'
+            r'([0-9]{4}[A-Z]+|UNKN)(-Misalign)?$')
+# Extension of the files of each format.
+_EXTS = {'npz': '.npz', 'parquet': '.parquet'}
+# Parquet compression for each csv compression.
+_PARQUET_CODECS = {None: 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+
+
+def partitionOf(out_fname):
+    """
+    Returns a dict with the partition keys of an output file name, and
+    'misaligned'. None if out_fname isn't an output file name.
+    """
+
+    ret_obj = _out_fname_re.match(out_fname)
+    if not ret_obj:
+        return None
+    part = dict(zip(PARTITION_KEYS, ret_obj.groups()[:5]))
+    part['misaligned'] = ret_obj.group(6) is not None
+    return part
+
+def outPath(outDir, out_fname, fmt):
+    """
+    Path of the output file of a branch in format fmt, npz or parquet,
+    within its partition of the dataset of that format. Output file
+    names which can't be split into partition keys are written to the
+    top of the dataset.
+    """
+
+    data_dir = os.path.join(outDir, fmt)
+    part = partitionOf(out_fname)
+    if part is None:
+        return os.path.join(data_dir, out_fname + _EXTS[fmt])
+    part_dir = os.path.join(data_dir, *['%s=%s' % (key, part[key]) for key
+                                        in PARTITION_KEYS])
+    return os.path.join(part_dir, out_fname + _EXTS[fmt])
+
+def branchArrays(br):
+    """
+    Returns the PRNs, totals, grace marks and subject marks of a Branch
+    as NumPy arrays. Marks are float32 with NaN where missing, a matrix
+    with one column per head of each subject.
+    """
+
+    prn = np.array(br.prn, dtype=str)
+    if br.totalArr is not None:
+        total, grace = br.totalArr, br.graceArr
+    else:
+        total = np.array([tmark[0] for tmark in br.totalMarks],
+                        dtype=np.float32)
+        grace = np.array([tmark[1] for tmark in br.totalMarks],
+                        dtype=np.float32)
+
+    if br.sMarkList is None or not br.subjects or not len(prn):
+        marks = np.zeros((len(prn), 0), dtype=np.float32)
+    else:
+        marks = np.asarray(br.sMarkList, dtype=np.float32)
+        marks = marks.reshape(len(prn), -1)
+
+    return prn, total, grace, marks
+
+def makeDirs(path):
+    """
+    Creates the directory path and its parents, if it isn't there.
+    Raises OSError if it can't be created; a file in its place raises
+    one with errno EEXIST.
+    """
+
+    try:
+        os.makedirs(path)
+    except OSError:
+        # Other runs or workers may have created it meanwhile.
+        if not os.path.isdir(path):
+            raise
+
+def _makeDirs(out_file):
+    """
+    Creates the partition directories of out_file.
+    """
+
+    out_dir = os.path.dirname(out_file)
+    if out_dir:
+        makeDirs(out_dir)
+
+def writeNPZ(out_file, br, columns, writePRN=True, compress=False):
+    """
+    Writes a Branch to a .npz file. The file holds the arrays prn (left
+    out if not writePRN), total, grace and marks, the names of the
+    columns of marks in columns, and the partition keys in meta as a
+    JSON string.
+    Arguments:
+            out_file: Path of the .npz file.
+            br: The Branch.
+            columns: Names of the subject mark columns.
+            writePRN: Whether PRNs are written.
+            compress: Whether the arrays are compressed.
+    """
+
+    prn, total, grace, marks = branchArrays(br)
+    arrays = {'total': total, 'grace': grace, 'marks': marks,
+              'columns': np.array(columns, dtype=str),
+              'meta': np.array(json.dumps(_meta(br)))}
+    if writePRN:
+        arrays['prn'] = prn
+
+    _makeDirs(out_file)
+    save = np.savez_compressed if compress else np.savez
+    tmp_name = tmpName(out_file)
+    try:
+        out = open(tmp_name, 'wb')
+        try:
+            save(out, **arrays)
+        finally:
+            out.close()
+        os.rename(tmp_name, out_file)
+    except:
+        removeQuietly(tmp_name)
+        raise
+
+def writeParquet(out_file, br, columns, writePRN=True, compress=None):
+    """
+    Writes a Branch to a Parquet file in long form, a row per head of
+    each subject of each student, so the files of every branch have the
+    same schema and read as one dataset. The columns are PRN, the
+    totals, subject, head and mark; totals and marks are nullable
+    integers. Students of a branch without subjects get a row each with
+    a null subject, head and mark. The partition keys are kept in the
+    file metadata too.
+    Arguments:
+            out_file: Path of the Parquet file.
+            br: The Branch.
+            columns: Names of the subject mark columns, as
+                    SUBJECT_HEAD.
+            writePRN: Whether PRNs are written.
+            compress: None, 'gzip' or 'zstd'. snappy is used for None.
+    """
+
+    prn, total, grace, marks = branchArrays(br)
+    # Heads have no '_' in them, subject abbreviations may.
+    subj_heads = [name.rsplit('_', 1) for name in columns]
+    if subj_heads:
+        row_idx = np.repeat(np.arange(len(prn)), len(subj_heads))
+        col_idx = np.tile(np.arange(len(subj_heads)), len(prn))
+        subjects = [subj_heads[idx][0] for idx in col_idx]
+        heads = [subj_heads[idx][1] for idx in col_idx]
+        mark = marks.ravel()
+    else:
+        row_idx = np.arange(len(prn))
+        subjects = heads = [None] * len(prn)
+        mark = np.empty(len(prn), dtype=np.float32)
+        mark.fill(np.nan)
+
+    names = []
+    cols = []
+    if writePRN:
+        names.append('PRN')
+        cols.append(pa.array(prn[row_idx].tolist(), type=pa.string()))
+    for name, values in [('TotalNoGrace', total), ('TotalGrace', grace),
+                         ('SumTotal', total + grace)]:
+        names.append(name)
+        cols.append(_intArray(values[row_idx], np.int32, pa.int32()))
+    names.extend(['subject', 'head', 'mark'])
+    cols.extend([pa.array(subjects, type=pa.string()),
+                 pa.array(heads, type=pa.string()),
+                 _intArray(mark, np.int16, pa.int16())])
+
+    table = pa.Table.from_arrays(cols, names)
+    table = table.replace_schema_metadata({'partition':
+                                           json.dumps(_meta(br))})
+    _makeDirs(out_file)
+    tmp_name = tmpName(out_file)
+    try:
+        pq.write_table(table, tmp_name,
+                       compression=_PARQUET_CODECS[compress])
+        os.rename(tmp_name, out_file)
+    except:
+        removeQuietly(tmp_name)
+        raise
+
+def tmpName(out_file):
+    """
+    The name out_file is written under before it's renamed into place,
+    so readers never see a partly written file. Unique to the process
+    and thread, so workers writing the same file don't clash.
+    """
+
+    return '%s.%d.%d.tmp' % (out_file, os.getpid(), thread.get_ident())
+
+def removeQuietly(path):
+    """
+    Removes a file, if it's there.
+    """
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _intArray(values, np_type, pa_type):
+    """
+    Turns a float array with NaN for missing values into a nullable
+    integer Arrow array.
+    """
+
+    missing = np.isnan(values)
+    return pa.array(np.where(missing, 0, values).astype(np_type),
+                    mask=missing, type=pa_type)
+
+def _meta(br):
+    """
+    Partition keys of a Branch.
+    """
+
+    return {'college': br.colAbbr, 'examPat': br.examPat, 'year': br.year,
+            'branch': br.brAbbr, 'exDate': br.exDate}
+
+def loadNPZ(in_file):
+    """
+    Reads a .npz file written by writeNPZ. Returns a dict with the
+    arrays, columns as a list and the partition keys.
+    """
+
+    npz = np.load(in_file)
+    try:
+        data = dict((key, npz[key]) for key in npz.files)
+    finally:
+        npz.close()
+    data['columns'] = data['columns'].tolist()
+    data.update(json.loads(str(data.pop('meta'))))
+    return data
+
+def readDataset(root, **filters):
+    """
+    Yields the branches of the .npz dataset under root, as loadNPZ
+    returns them. Only partitions matching filters are read, so
+    readDataset('outCSV/npz', year='BE') doesn't open the files of
+    other years.
+    """
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        # Prune partitions not matching the filters.
+        keep = []
+        for dir_name in sorted(dir_names):
+            key, sep, val = dir_name.partition('=')
+            if sep and key in filters and filters[key] != val:
+                continue
+            keep.append(dir_name)
+        dir_names[:] = keep
+        for file_name in sorted(file_names):
+            if file_name.endswith('.npz'):
+                yield loadNPZ(os.path.join(dir_path, file_name))
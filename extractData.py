@@ -6,6 +6,13 @@ pdf file.
 import re
 import math
 import inspect
+import instrument
+
+# NumPy is only needed for the columnar representation of marks.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class Branch(object):
@@ -13,11 +20,15 @@ class Branch(object):
     Holds information for a give branch.
 
     Attributes: brAbbr, prnCount, tmCount, subvCount, colAbr,
-            year, exDate, exPat
+            year, exDate, exPat, subjDict, totalArr, graceArr
+
+    In the columnar representation sMarkList is a NumPy matrix rather
+    than a list of lists, and totalArr and graceArr hold the totals.
     """
     def __init__(self, brAbbr='UNKN', prn=None, totalMarks=None, 
             sMarkList=None, subjects=None, colAbbr='UNKN', year='UNKN', 
-            exDate='UNKN', examPat='UNKN'):
+            exDate='UNKN', examPat='UNKN', subjDict=None, totalArr=None,
+            graceArr=None):
         self.brAbbr = brAbbr
         self.prn = prn
         self.totalMarks = totalMarks
@@ -27,15 +38,444 @@ class Branch(object):
         self.year = year
         self.exDate = exDate
         self.examPat = examPat
+        self.subjDict = subjDict
+        self.totalArr = totalArr
+        self.graceArr = graceArr
 
     def __str__(self):
         return ('PRN count: %d\nTotal marks count: %d\nSubject vec count:'
                 ' %d\nCollege abbr: %s\nYear: %s\nBranch abbr: %s\nExam date:'
                 ' %s\nExam pattern: %s\n') % (len(self.prn),
-                len(self.totalMarks), len(self.sMarkList), self.colAbbr, 
+                len(self.totalMarks), (len(self.sMarkList) if
+                self.sMarkList is not None else 0), self.colAbbr, 
                 self.year, self.brAbbr, self.exDate, self.examPat)
 
 
+# Regular expressions used by the single pass parser. Each of them is
+# applied only to the kind of line it can possibly match.
+_patCom_re = re.compile(r'.*PUNE.*\(([0-9]{4})\s*[A-Z\.]+\).*')
+_colCom_re = re.compile(r'\s*(?:[A-Z][0-9]{8}).*,\s*([A-Z]+)\s*,')
+_yrCom_re = re.compile(r'.*\s*([FSTBE\.]{4})(?:\([0-9]{4}\s*[A-Z\.]+\))')
+_ex08_re = re.compile(r'.*PUNE.*\s+([A-Z]+\s+[0-9]{4}$)')
+_ex12_re = re.compile(r'.*PUNE.*\,.*([A-Z]{3,}\s+[0-9]{4})$')
+_br08_re = re.compile(r'.*PUNE.*\([0-9]{4}\s*PAT.*\)\s*\(([A-Z\.\-&\s]+)(\s|'
+            r'\)).*')
+_br12_re = re.compile(r'^BRANCH.*\(([A-Z\.\&\s]+)\)$')
+_PRNCom_re = re.compile(r'([0-9]{8}[A-Z])')
+# Page header lines; the title with the university, the BRANCH line of
+# 2012 sheets and the line with the date and the exam centre. 'PUNE'
+# alone may be in the name of a student.
+_pageHdr_re = re.compile(r'(?:.*(?:PUNE\s+UNIVERSITY|UNIVERSITY\s+OF\s+PUNE)|'
+            r'BRANCH|DATE\s*:.*CENTRE\s*:)')
+# Find a 1 to 4 digit total or a 1 to 4 digit total
+# with a grace mark awarded for a better class
+_gtCom_re = re.compile(r'^GRAND TOTAL\s*=\s*([0-9]{1,4}|[0-9]{1,4}\s*\+\s*'
+            r'[0-9]+|--)/.*')
+_subj_re = re.compile(r'((?:[0-9]{3}|[0-9]{2}[A-Z]{1}|[0-9]{2})\s*\.\s*'
+            r'[-A-Z1-3\s\.&\(\)\,\/]+)\s*(?=PP|PR|OR|TW)')
+# A single column of a mark line. Subject code, subject name, head of
+# passing and, when they could be read, the marks obtained.
+_markTok_re = re.compile(r'([0-9]{3}|[0-9]{2}[A-Z]{1}|[0-9]{2})\s*\.\s*'
+            r'([-A-Z1-3\s\.&\(\)\,\/]+)\s*(PP|TW|OR|PR)(?:\s+(?:100|[0-9]'
+            r'[0-9])\s+(?:[0-9][0-9])\s+([0-9][0-9]|100|[A-Z]{2})(?=.))?')
+# Position of each head of passing in a subjects list of marks.
+_HEAD_IDX = {'PP': 0, 'PR': 1, 'OR': 2, 'TW': 3}
+# Columns of the marks of a subject in a row of marks, by exam pattern.
+# 2012 sheets also split the PP marks into internal and theory marks.
+HEADS = {'2008': ('PP', 'PR', 'OR', 'TW'),
+        '2012': ('PP', 'PR', 'OR', 'TW', 'INT', 'TH')}
+# A column of a 2012 mark line up to the marks obtained; the six digit
+# subject code, subject name, head of passing, max and min marks. The
+# marks obtained run up to the next column.
+_col12_re = re.compile(r'(?:^|\s)([0-9]{6})\s+(\S.*?)\s+(PP|PR|OR|TW)\s+'
+            r'(?:100|[0-9]{2})\s+[0-9]{2}(?=\s|$)')
+# Marks of 2012 mark lines met so far, by their text. There are few.
+_marks12 = {}
+_NAN = float('NaN')
+# Characters allowed in a subject name by the regexes above.
+_NAME_CHARS = '-ABCDEFGHIJKLMNOPQRSTUVWXYZ123 \t\n\r\f\v.&(),/'
+# A subject column can't start where any of these are found.
+_CODE_CHARS = '0123456789.'
+# Number of offsets of a column kept in the layout of the mark lines.
+_LAYOUT_OFFSETS = 4
+# Number of mark lines a cached subject catalog is checked against.
+_CATALOG_SAMPLE = 40
+_subj_code_re = re.compile(r'^([0-9]{3}|[0-9]{2}[A-Z]{1}|[0-9]{2})\s*\.\s*'
+            r'([-A-Z1-3\s\.&\(\)\,\/]+)$')
+
+# Fields scanContent knows how to extract.
+FIELDS = ('exPat', 'college', 'year', 'exDate', 'branch', 'prn', 'total',
+        'subjDict', 'markLines', 'markStarts', 'matches')
+# Fields which are settled by the first line matching them.
+_FIRST_FIELDS = ('exPat', 'college', 'exDate', 'branch')
+# Fields found in the page header and the first student header line.
+HEADER_FIELDS = ('exPat', 'college', 'year', 'exDate', 'branch')
+# Number of lines at the start of a branch the header fields are
+# looked for in before the whole branch is scanned.
+_HEADER_WINDOW = 40
+
+# States of the parser. Between records (page header, separators) or
+# within the mark lines of a student.
+_ST_PAGE, _ST_MARKS = range(2)
+
+
+def scanContent(in_content, examPat='UNKN', fields=FIELDS):
+    """
+    Walks the content once and extracts the requested fields.
+
+    The walk is a small state machine. Page header lines carry the
+    exam pattern, exam date, branch and year. The student header line
+    carries the PRN and college and is followed by the mark lines of
+    that student till the GRAND TOTAL line closes the record.
+    markStarts are the positions in markLines of the first mark line of
+    each student. matches is the number of matches of the regular
+    expressions applied in the walk.
+    Arguments:
+            in_content: Iterable with each line of input as one element.
+            examPat: Pattern of exam. 2008 or 2012. Decides how the exam
+                    date, branch and subjects are found.
+            fields: Iterable naming the fields in FIELDS to extract.
+    Returns a dict keyed by the names of the requested fields.
+    """
+
+    want = set(fields)
+    err_msg = ("%s got unknown fields %s" % (inspect.stack()[0][3],
+                sorted(want.difference(FIELDS))))
+    assert want.issubset(FIELDS), err_msg
+
+    if examPat == '2008':
+        ex_re, br08_re, br12_re = _ex08_re, _br08_re, None
+    elif examPat == '2012':
+        ex_re, br08_re, br12_re = _ex12_re, None, _br12_re
+    else:
+        ex_re, br08_re, br12_re = None, None, None
+
+    get_pat = 'exPat' in want
+    get_col = 'college' in want
+    get_yr = 'year' in want
+    get_ex = 'exDate' in want and ex_re is not None
+    get_br = 'branch' in want
+    get_prn = 'prn' in want
+    get_tot = 'total' in want
+    get_subj = 'subjDict' in want and examPat in ('2008', '2012')
+    get_mark = 'markLines' in want
+    get_start = 'markStarts' in want
+    # Student header lines need to be spotted to track the state.
+    get_rec = get_prn or get_col or get_subj or get_mark or get_start
+    # Nothing but first match fields asked for; stop once they're found.
+    first_only = want.issubset(_FIRST_FIELDS)
+    first_count = len(want.intersection(_FIRST_FIELDS))
+
+    found = {}
+    year = None
+    PRN_list = []
+    totalMarks = []
+    subjects = []
+    subjects_seen = set()
+    mark_lines = []
+    mark_starts = []
+    matches = 0
+
+    state = _ST_PAGE
+    for line in in_content:
+        line = line.strip()
+        if not line:
+            continue
+
+        # End of a student record.
+        if line.startswith('GRAND TOTAL'):
+            state = _ST_PAGE
+            if get_tot:
+                tmark = _gtCom_re.findall(line)
+                if tmark:
+                    matches += 1
+                    totalMarks.append(_parseTotal(tmark[0]))
+            continue
+
+        # Page header lines.
+        if isPageHeader(line):
+            state = _ST_PAGE
+            if get_pat and 'exPat' not in found:
+                ret_obj = _patCom_re.match(line)
+                if ret_obj:
+                    matches += 1
+                    found['exPat'] = ret_obj.group(1)
+            if get_ex and 'exDate' not in found:
+                ret_obj = ex_re.match(line)
+                if ret_obj:
+                    matches += 1
+                    found['exDate'] = ret_obj.group(1)
+            if get_br and 'branch' not in found:
+                if br08_re is not None:
+                    ret_obj = br08_re.match(line)
+                elif br12_re is not None:
+                    ret_obj = br12_re.match(line)
+                else:
+                    ret_obj = None
+                if ret_obj:
+                    matches += 1
+                    found['branch'] = ret_obj.group(1)
+            # Year is taken from the last header line which has it.
+            if get_yr and '(' in line:
+                ret_obj = _yrCom_re.match(line)
+                if ret_obj:
+                    matches += 1
+                    year = ret_obj.group(1)
+            if first_only and len(found) == first_count:
+                break
+            continue
+
+        # Student header line; the line with the PRN.
+        if get_rec:
+            PRN = _PRNCom_re.search(line)
+            if PRN:
+                matches += 1
+                state = _ST_MARKS
+                if get_prn:
+                    PRN_list.append(PRN.group(1))
+                if get_start:
+                    mark_starts.append(len(mark_lines))
+                if get_col and 'college' not in found:
+                    ret_obj = _colCom_re.match(line)
+                    if ret_obj:
+                        matches += 1
+                        found['college'] = ret_obj.group(1)
+                if first_only and len(found) == first_count:
+                    break
+                continue
+
+        # Mark lines of the current student.
+        if state == _ST_MARKS:
+            if get_subj and examPat == '2008':
+                for s_i in _subj_re.findall(line):
+                    matches += 1
+                    s_i = s_i.strip()
+                    if s_i not in subjects_seen:
+                        subjects_seen.add(s_i)
+                        subjects.append(s_i)
+            elif get_subj:
+                for tok in _col12_re.finditer(line):
+                    matches += 1
+                    if tok.group(1) not in subjects_seen:
+                        subjects_seen.add(tok.group(1))
+                        subjects.append(tok.group(1, 2))
+            if get_mark:
+                mark_lines.append(line)
+
+    scanned = {}
+    if get_pat:
+        # Only expected values be returned
+        pat = found.get('exPat', 'UNKN')
+        scanned['exPat'] = pat if pat in ('2008', '2012') else 'UNKN'
+    if get_col:
+        scanned['college'] = found.get('college', 'UNKN')
+    if get_yr:
+        year = year.replace('.', '') if year is not None else 'UNKN'
+        # Only expected values be returned
+        scanned['year'] = year if year in ('BE', 'TE', 'SE', 'FE') else 'UNKN'
+    if 'exDate' in want:
+        scanned['exDate'] = _swapExamDate(found.get('exDate', 'UNKN'))
+    if get_br:
+        scanned['branch'] = makeAbbr(found.get('branch', 'UNKN'))
+    if get_prn:
+        scanned['prn'] = PRN_list
+    if get_tot:
+        scanned['total'] = totalMarks
+    if 'subjDict' in want:
+        if examPat == '2008':
+            scanned['subjDict'] = _splitSubjects(subjects)
+        elif examPat == '2012':
+            scanned['subjDict'] = dict(subjects)
+        else:
+            scanned['subjDict'] = []
+    if get_mark:
+        scanned['markLines'] = mark_lines
+    if get_start:
+        scanned['markStarts'] = mark_starts
+    if 'matches' in want:
+        scanned['matches'] = matches
+
+    return scanned
+
+def isPageHeader(line):
+    """
+    Whether a stripped line of the input is a page header line. Student
+    header lines, those with a PRN, never are.
+    """
+
+    return (_pageHdr_re.match(line) is not None and
+            _PRNCom_re.search(line) is None)
+
+def sniffHeader(in_content, examPat='UNKN', fields=HEADER_FIELDS,
+        window=_HEADER_WINDOW):
+    """
+    Finds the header fields of a branch; the exam pattern, college,
+    year, exam date and branch. These are in the page header and the
+    first student header line so only the first window lines are read.
+    Fields not found there are looked for in all of in_content.
+    Arguments:
+            in_content: List with each line of input as one element of
+                    the list.
+            examPat: Pattern of exam. 2008 or 2012.
+            fields: Iterable naming the fields in HEADER_FIELDS to find.
+            window: Number of lines at the start of in_content to look
+                    in first.
+    Returns a dict keyed by the names of the requested fields.
+    """
+
+    header = scanContent(in_content[:window], examPat, fields)
+    missing = [field for field in fields if header[field] == 'UNKN']
+    if missing and len(in_content) > window:
+        header.update(scanContent(in_content, examPat, missing))
+
+    return header
+
+def parseBranch(in_content, examPat, getMarks=True, columnar=False,
+        catalog=None, header=None, prof=None, getSubjects=True):
+    """
+    Fills a Branch from the content of a single branch in one pass
+    over the content, after the header fields are sniffed.
+    Arguments:
+            in_content: List with each line of input as one element of
+                    the list.
+            examPat: Pattern of exam. 2008 or 2012.
+            getMarks: Whether subject marks should be extracted. When
+                    False sMarkList is left as None.
+            columnar: Whether subject marks should be held in a NumPy
+                    matrix, see getSubjMarkArray.
+            catalog: Optional cache of subject catalogs, with get(key)
+                    and put(key, subjPairs) methods, see subjCatalog.
+                    Subjects are only discovered from the content when
+                    the catalog misses or doesn't fit the content.
+            header: The header fields of the branch as returned by
+                    sniffHeader. Found here if not given.
+            prof: Optional instrument.Profile the time spent in the
+                    scan, subjects and marks stages is added to.
+            getSubjects: Whether the subjects should be found when marks
+                    aren't asked for. When neither are, subjects is
+                    left empty and subjDict as None.
+    """
+
+    if prof is None:
+        prof = instrument.NullProfile('parseBranch')
+    if header is None:
+        with prof.timed('header'):
+            header = sniffHeader(in_content, examPat)
+    getSubjects = getSubjects or getMarks
+    use_cat = catalog is not None and examPat == '2008' and getSubjects
+    fields = ['prn', 'total']
+    if getSubjects and not use_cat:
+        fields.append('subjDict')
+    if getMarks or use_cat:
+        fields.append('markLines')
+    if getMarks and examPat == '2012':
+        fields.append('markStarts')
+    fields.append('matches')
+    with prof.timed('scan'):
+        scanned = scanContent(in_content, examPat, fields)
+    prof.count('mark_lines', len(scanned.get('markLines', [])))
+    prof.count('regex_matches', scanned['matches'])
+
+    br = Branch(brAbbr=header['branch'], prn=scanned['prn'],
+            totalMarks=scanned['total'], colAbbr=header['college'],
+            year=header['year'], exDate=header['exDate'],
+            examPat=examPat)
+
+    if not getSubjects:
+        br.subjects = []
+    else:
+        with prof.timed('subjects'):
+            if use_cat:
+                cat_key = (examPat, br.year, br.brAbbr)
+                subjPairs = catalog.get(cat_key)
+                cat_hit = subjPairs is not None and catalogFits(subjPairs,
+                                    scanned['markLines'][:_CATALOG_SAMPLE])
+                # Without marks to check it against, the whole of the
+                # branch is checked for codes the catalog lacks or has
+                # over.
+                if cat_hit and not getMarks:
+                    cat_hit = catalogFits(subjPairs, scanned['markLines'],
+                                          exact=True)
+                if not cat_hit:
+                    subjPairs = discoverSubjects(scanned['markLines'])
+                    catalog.put(cat_key, subjPairs)
+                br.subjDict = dict(subjPairs)
+            else:
+                br.subjDict = scanned['subjDict']
+            if examPat in ('2008', '2012'):
+                br.subjects = _groupSubjects(br.subjDict, examPat)
+            else:
+                br.subjects = []
+
+    # Marks are only meaningful when there are subjects and students to
+    # attach them to. Outer routine reports the failure otherwise.
+    if getMarks:
+        with prof.timed('marks'):
+            if columnar:
+                getMarksFunc = getSubjMarkArray
+            else:
+                getMarksFunc = getSubjMark
+            if br.subjects and br.prn:
+                unknown = set()
+                codes = set()
+                br.sMarkList = getMarksFunc(scanned['markLines'],
+                                br.subjects, len(br.prn), examPat, unknown,
+                                scanned.get('markStarts'), codes)
+                # A subject code missing from a cached catalog, or one the
+                # branch doesn't have, such as an elective of another
+                # college. The catalog doesn't fit this branch; discover
+                # the subjects afresh so the output is what discovery
+                # gives.
+                if use_cat and cat_hit and (unknown.difference(br.subjDict)
+                                        or codes.symmetric_difference(
+                                        br.subjDict)):
+                    subjPairs = discoverSubjects(scanned['markLines'])
+                    catalog.put(cat_key, subjPairs)
+                    br.subjDict = dict(subjPairs)
+                    br.subjects = _groupSubjects(br.subjDict)
+                    br.sMarkList = getMarksFunc(scanned['markLines'],
+                                        br.subjects, len(br.prn), examPat)
+            else:
+                br.sMarkList = getMarksFunc([], [], 0, examPat)
+
+    return br
+
+def discoverSubjects(in_content):
+    """
+    Finds the subjects and subject codes in the mark lines of a 2008
+    pattern branch. Returns a list of (code, subject) pairs in the
+    order getSubjDict builds its dict from, so that dict() of the list
+    equals what getSubjDict returns.
+    """
+
+    subjects = []
+    subjects_seen = set()
+    for line in in_content:
+        for s_i in _subj_re.findall(line):
+            s_i = s_i.strip()
+            if s_i not in subjects_seen:
+                subjects_seen.add(s_i)
+                subjects.append(s_i)
+
+    return _subjectPairs(subjects)
+
+def catalogFits(subjPairs, in_content, exact=False):
+    """
+    Checks that every subject code found in the (sample of) mark lines
+    in in_content is in the catalog subjPairs. If exact, every subject
+    of the catalog must be found in them too.
+    """
+
+    codes = set(code for code, s_name in subjPairs)
+    seen = set()
+    for line in in_content:
+        for s_i in _subj_re.findall(line):
+            for code, s_name in _subj_code_re.findall(s_i.strip()):
+                if code not in codes:
+                    return False
+                seen.add(code)
+    return not exact or seen == codes
+
 def getExPat(in_content):
     """
     Get exam pattern from the file. Only handles 2012 and 2008 format
@@ -46,21 +486,7 @@ def getExPat(in_content):
                 (inspect.stack()[0][3], type(in_content)))
     assert (type(in_content) is list), err_msg
 
-    patCom_re = r'.*PUNE.*\(([0-9]{4})\s*[A-Z\.]+\).*'
-    pat = 'UNKN'
-
-    for line in in_content:
-        line = line.strip()
-        ret_obj = re.match(patCom_re, line)
-        if ret_obj:
-            pat = ret_obj.group(1)
-            break
-
-    # Only expected values be returned
-    if pat.strip() in ('2008', '2012'):
-        return pat.strip()
-    else:
-        return 'UNKN'
+    return scanContent(in_content, fields=('exPat',))['exPat']
 
 def getCollege(in_content):
     """
@@ -71,17 +497,7 @@ def getCollege(in_content):
                 (inspect.stack()[0][3], type(in_content)))
     assert (type(in_content) is list), err_msg
 
-    colCom_re = r'\s*(?:[A-Z][0-9]{8}).*,\s*([A-Z]+)\s*,'
-    col_name = 'UNKN'
-
-    for line in in_content:
-        line = line.strip()
-        ret_obj = re.match(colCom_re, line)
-        if ret_obj:
-            col_name = ret_obj.group(1)
-            break
-
-    return col_name
+    return scanContent(in_content, fields=('college',))['college']
 
 def getYear(in_content):
     """
@@ -92,22 +508,8 @@ def getYear(in_content):
                 (inspect.stack()[0][3], type(in_content)))
     assert (type(in_content) is list), err_msg
 
-    yrCom_re = r'.*\s*([FSTBE\.]{4})(?:\([0-9]{4}\s*[A-Z\.]+\))'
-    year = 'UNKN'
-
-    for line in in_content:
-        line = line.strip()
-        ret_obj = re.match(yrCom_re, line)
-        if ret_obj:
-            year = ret_obj.group(1)
-
-    year = year.replace('.', '')
-
-    # Only expected values be returned
-    if year.strip() in ('BE', 'TE', 'SE', 'FE'):
-        return year.strip()
-    else:
-        return 'UNKN'
+    # Year is in every page header; the first few lines settle it.
+    return sniffHeader(in_content, fields=('year',))['year']
 
 
 def getExamDate(in_content, examPat):
@@ -120,22 +522,13 @@ def getExamDate(in_content, examPat):
                 (inspect.stack()[0][3], type(in_content), type(examPat)))
     assert (type(in_content) is list and type(examPat) is str), err_msg
 
-    ex08_re = r'.*PUNE.*\s+([A-Z]+\s+[0-9]{4}$)'
-    ex12_re = r'.*PUNE.*\,.*([A-Z]{3,}\s+[0-9]{4})$'
-    ex = 'UNKN'
-    if examPat == '2008':
-        ex_re = ex08_re
-    elif examPat == '2012':
-        ex_re = ex12_re
+    return scanContent(in_content, examPat, ('exDate',))['exDate']
 
-    for line in in_content:
-        line = line.strip()
-        ret_obj = re.match(ex_re, line)
-        if ret_obj:
-            ex = ret_obj.group(1)
-            break
+def _swapExamDate(ex):
+    """
+    Turn 'MAY 2015' to '2015MAY'.
+    """
 
-    # Turn 'MAY 2015' to '2015MAY'.
     ex = ex.split()
     if len(ex) == 2:
         ex[0], ex[1] = ex[1], ex[0]
@@ -153,23 +546,7 @@ def getBranch(in_content, examPat):
                 (inspect.stack()[0][3], type(in_content), type(examPat)))
     assert (type(in_content) is list and type(examPat) is str), err_msg
 
-    br08_re = (r'.*PUNE.*\([0-9]{4}\s*PAT.*\)\s*\(([A-Z\.\-&\s]+)(\s|'
-                '\)).*')
-    br12_re = r'^BRANCH.*\(([A-Z\.\&\s]+)\)$'
-    branch = 'UNKN'
-    if examPat == '2008':
-        br_re = br08_re
-    elif examPat == '2012':
-        br_re = br12_re
-
-    for line in in_content:
-        line = line.strip()
-        ret_obj = re.match(br_re, line)
-        if ret_obj:
-            branch = ret_obj.group(1)
-            break
-
-    return makeAbbr(branch)
+    return scanContent(in_content, examPat, ('branch',))['branch']
 
 def getPRN(in_content):
     """
@@ -180,16 +557,7 @@ def getPRN(in_content):
                 (inspect.stack()[0][3], type(in_content)))
     assert (type(in_content) is list), err_msg
 
-    PRN_list = []
-    PRNCom_re = r'([0-9]{8}[A-Z])'
-
-    for line in in_content:
-        line = line.strip()
-        PRN = re.findall(PRNCom_re, line)
-        if PRN:
-            PRN_list.append(PRN[0])
-
-    return PRN_list
+    return scanContent(in_content, fields=('prn',))['prn']
 
 def getTotal(in_content):
     """
@@ -200,37 +568,33 @@ def getTotal(in_content):
                     (inspect.stack()[0][3], type(in_content)))
     assert (type(in_content) is list), err_msg
 
-    totalMarks = []
-    # Find a 1 to 4 digit total or a 1 to 4 digit total
-    # with a grace mark awarded for a better class
-    gtCom_re = (r'^GRAND TOTAL\s*=\s*([0-9]{1,4}|[0-9]{1,4}\s*\+\s*[0-9]+'
-                r'|--)/.*')
+    return scanContent(in_content, fields=('total',))['total']
 
-    for line in in_content:
-        line = line.strip()
-        tmark = re.findall(gtCom_re, line)
-        if tmark:
-            try:
-                totalMarks.append((int(tmark[0]), 0))
-            except ValueError:
-                # For the case where kid is F-ATKT in 2012 pattern files.
-                if tmark[0].strip() == '--':
-                    totalMarks.append((float('NaN'), float('NaN')))
-                # For the case where grace marks have been given.
-                else:
-                    total_grace = tmark[0].split('+')
-                    totalMarks.append((int(total_grace[0]),
-                            int(total_grace[1])))
+def _parseTotal(tmark):
+    """
+    Turns the matched grand total into a (total, grace) tuple.
+    """
 
-    return totalMarks
+    try:
+        return (int(tmark), 0)
+    except ValueError:
+        # For the case where kid is F-ATKT in 2012 pattern files.
+        if tmark.strip() == '--':
+            return (float('NaN'), float('NaN'))
+        # For the case where grace marks have been given.
+        else:
+            total_grace = tmark.split('+')
+            return (int(total_grace[0]), int(total_grace[1]))
 
-def getSubjMark(in_content, br_subjects, PRN_len, examPat):
+def getSubjMark(in_content, br_subjects, PRN_len, examPat, unknown=None,
+        starts=None, codes=None):
     """
     Extract the marks for the subjects passed in 'br_subjects' subject.
 
     Once marks are obtained getSubjMark formats the marks appropriately.
     Silently pads the data if all the data could not be extracted
-    correctly. Only handles 2008 pattern marks at present.
+    correctly. Each student gets a list with the marks of each subject
+    in the order of HEADS[examPat].
     Arguments:
             in_content: List with each line of input as one element of the
                     list.
@@ -238,10 +602,17 @@ def getSubjMark(in_content, br_subjects, PRN_len, examPat):
                     curriculum for a given branch of engineering.
             PRN_len: Number of students in the branch being processed.
             examPat: Pattern of exam. 2008 or 2012.
+            unknown: Optional set to which the codes of subjects not in
+                    br_subjects are added.
+            starts: Positions in in_content of the first mark line of
+                    each student, the markStarts of scanContent. Only
+                    used for 2012 pattern marks; found from the 'SEM.:'
+                    lines when not given.
+            codes: Optional set to which the codes of all the subjects
+                    met are added. Only filled for 2008 pattern marks.
 
     """
     #TODO: Notify when padding has been performed.
-    #TODO: Handle 2012 marks. Will likely need significant reworking.
 
     err_msg = ("%s expected argument of type 'list','list','int','str';"
                 " %s,%s,%s,%s given" % (inspect.stack()[0][3],
@@ -250,12 +621,17 @@ def getSubjMark(in_content, br_subjects, PRN_len, examPat):
     assert (type(in_content) is list and type(br_subjects) is list and
             type(PRN_len) is int and type(examPat) is str), err_msg
 
-    # Only handles 2008 pattern files for now.
+    # 2012 pattern marks are laid out by student; rows are cut from the
+    # matrix of the branch.
+    if examPat == '2012':
+        cells, width = _getMarks12(in_content, br_subjects, PRN_len,
+                                starts, unknown)
+        return [cells[row*width:(row+1)*width] for row in range(PRN_len)]
     if examPat != '2008':
         return []
 
     # Lower level function actually getting the marks.
-    sMarkList_all = _getMarks(in_content, br_subjects)
+    sMarkList_all = _getMarks(in_content, br_subjects, unknown, codes)
 
     # The sMarkList_all now contains marks of different types of exams
     # (PP|TW|OR|PR) as separate lists. For a given subject, merge
@@ -278,64 +654,357 @@ def getSubjMark(in_content, br_subjects, PRN_len, examPat):
     # Partially flatten sMarkList_mer so that all marks of a single kid
     # are in a single list
     sMarkList_flatmer = []
-    flat_temp = []
     for kid_idx in range(PRN_len):
+        flat_temp = []
         for subj_idx in range(len(br_subjects)):
-            flat_temp = flat_temp+sMarkList_mer[subj_idx][kid_idx]
+            flat_temp.extend(sMarkList_mer[subj_idx][kid_idx])
         sMarkList_flatmer.append(flat_temp)
-        flat_temp = []
 
     return sMarkList_flatmer
 
-def _getMarks(in_content, br_subjects):
+def getSubjMarkArray(in_content, br_subjects, PRN_len, examPat,
+        unknown=None, starts=None, codes=None):
+    """
+    Columnar version of getSubjMark. Returns a float32 NumPy matrix with
+    a row per student and the (PP, PR, OR, TW) marks of each subject in
+    br_subjects as columns. Merging and padding with 'nan' are done on
+    the whole matrix at once. Needs NumPy.
+    Arguments:
+            Same as getSubjMark.
+    """
+
+    err_msg = ("%s expected argument of type 'list','list','int','str';"
+                " %s,%s,%s,%s given" % (inspect.stack()[0][3],
+                type(in_content), type(br_subjects), type(PRN_len),
+                type(examPat)))
+    assert (type(in_content) is list and type(br_subjects) is list and
+            type(PRN_len) is int and type(examPat) is str), err_msg
+    assert np is not None, "%s needs NumPy" % inspect.stack()[0][3]
+
+    if examPat == '2012':
+        cells, width = _getMarks12(in_content, br_subjects, PRN_len,
+                                starts, unknown)
+        return np.array(cells, dtype=np.float32).reshape(PRN_len, width)
+    if examPat != '2008':
+        return np.zeros((0, 0), dtype=np.float32)
+
+    sMarkArr = np.empty((PRN_len, 4*len(br_subjects)), dtype=np.float32)
+    sMarkArr.fill(np.nan)
+
+    for subj_idx, slist in enumerate(_getMarks(in_content, br_subjects,
+                                                unknown, codes)):
+        marks = np.array(slist, dtype=np.float32).reshape(-1, 4)
+        # Rows of the different types of exams of a subject are summed
+        # m_factor at a time, as in _mergeMarks. The last lot may be
+        # short, zeros don't change its sum.
+        m_factor = int(math.ceil(len(slist)/float(PRN_len)))
+        if m_factor > 1:
+            short = -len(marks) % m_factor
+            if short:
+                marks = np.vstack((marks, np.zeros((short, 4),
+                                                dtype=np.float32)))
+            marks = marks.reshape(-1, m_factor, 4).sum(axis=1)
+        # Rows past the marks found stay 'nan'.
+        sMarkArr[:len(marks), 4*subj_idx:4*subj_idx+4] = marks
+
+    return sMarkArr
+
+def getTotalArrays(totalMarks):
+    """
+    Columnar version of the totals. Returns float32 NumPy arrays of the
+    totals and of the grace marks in totalMarks. Needs NumPy.
+    """
+
+    assert np is not None, "%s needs NumPy" % inspect.stack()[0][3]
+
+    tm_arr = np.array(totalMarks, dtype=np.float32).reshape(-1, 2)
+    return tm_arr[:, 0].copy(), tm_arr[:, 1].copy()
+
+def _getMarks(in_content, br_subjects, unknown=None, codes=None):
     """
     Gets the marks from the content. Returns a multi-dimensional list
     with marks for a given type of exam each contained in a list of
     its own. Higher level functions may manipulate the results to
     suit their needs.
-    """
 
-    sMarkList_all = []
-    sMarkList_cur = []
-    sMarkList_tmp = [0]*4
+    Each line is tokenized once into (code, subject, head, marks) for
+    both the columns of the line, by slicing it at the column offsets
+    of the lines before it when it fits them and by regex otherwise.
+    Every token is then routed to its subject through a dict keyed on
+    the subject code. Codes which route to no subject are added to the
+    set unknown, and all codes met to the set codes, if given.
+    """
 
-    # regex string that changes with each subject and gets marks.
-    base_re = (r'\s*(PP|TW|OR|PR)\s+(?:100|[0-9][0-9])\s+(?:[0-9][0-9])\s+'
-                    r'([0-9][0-9]|100|[A-Z]{2}).+')
+    sMarkList_all = [[] for subj in br_subjects]
+
+    # Escaped subject names to the positions in br_subjects which
+    # match them. Electives are alternations of escaped names.
+    subj_idx = {}
+    for i, subj in enumerate(br_subjects):
+        for s_name in subj[1:-1].split('|'):
+            subj_idx.setdefault(s_name, []).append(i)
+    # Subject code and name to the positions in br_subjects, filled as
+    # the codes are met. The name is part of the key since codes are
+    # only unique within a branch.
+    code_idx = {}
+
+    # pdftotext -layout keeps the columns of the mark lines in place, so
+    # most lines can be sliced at the offsets of the lines before them.
+    # Lines which don't fit the layout are tokenized by the regex, and
+    # the layout learnt from them.
+    layout = []
+    seen = ({}, {}, {})
 
-    for subj in br_subjects:
-        subj_re = ''.join([subj, base_re])
-        for line in in_content:
-            line = line.strip()
-            subjMark = re.findall(subj_re, line)
-            if subjMark:
+    for line in in_content:
+        line = line.strip()
+        tokens = _sliceMarks(line, layout, seen)
+        if tokens is None:
+            tokens = _learnOffsets(layout, line)
+        line_idx = []
+        for code, s_name, head, mark in tokens:
+            if codes is not None:
+                codes.add(code)
+            # Head without marks, could not be read.
+            if not mark:
+                continue
+            idx = code_idx.get((code, s_name))
+            if idx is None:
+                idx = subj_idx.get(re.escape(s_name.strip()), [])
+                code_idx[(code, s_name)] = idx
+                if not idx and unknown is not None:
+                    unknown.add(code)
+            for i in idx:
+                # Only the first column of a line counts for a subject.
+                if i in line_idx:
+                    continue
+                line_idx.append(i)
+                sMarkList_tmp = [0]*4
                 try:
-                    if subjMark[0][1] == 'PP':
-                        sMarkList_tmp[0] = int(subjMark[0][2])
-                    elif subjMark[0][1] == 'PR':
-                        sMarkList_tmp[1] = int(subjMark[0][2])
-                    elif subjMark[0][1] == 'OR':
-                        sMarkList_tmp[2] = int(subjMark[0][2])
-                    elif subjMark[0][1] == 'TW':
-                        sMarkList_tmp[3] = int(subjMark[0][2])
+                    sMarkList_tmp[_HEAD_IDX[head]] = int(mark)
                 except ValueError:
                     # For the case of absent students
-                    if subjMark[0][1] == 'PP':
-                        sMarkList_tmp[0] = float('NaN')
-                    elif subjMark[0][1] == 'PR':
-                        sMarkList_tmp[1] = float('NaN')
-                    elif subjMark[0][1] == 'OR':
-                        sMarkList_tmp[2] = float('NaN')
-                    elif subjMark[0][1] == 'TW':
-                        sMarkList_tmp[3] = float('NaN')
-                sMarkList_cur.append(sMarkList_tmp)
-                sMarkList_tmp = [0]*4
-
-        sMarkList_all.append(sMarkList_cur)
-        sMarkList_cur = []
+                    sMarkList_tmp[_HEAD_IDX[head]] = float('NaN')
+                sMarkList_all[i].append(sMarkList_tmp)
 
     return sMarkList_all
 
+def _getMarks12(in_content, br_subjects, PRN_len, starts=None,
+        unknown=None):
+    """
+    Gets the marks of a 2012 pattern branch in one pass over its mark
+    lines, both semester columns of each line at a time. Returns the
+    marks as one flat list, row by row, and the length of a row. A row
+    holds the HEADS['2012'] marks of each subject in br_subjects. Heads
+    a student's subject doesn't have are 0, marks which couldn't be read
+    and subjects the student didn't take are 'nan'.
+    """
+
+    width = len(HEADS['2012'])
+    row_len = width*len(br_subjects)
+    cells = [float('NaN')]*(PRN_len*row_len)
+
+    subj_idx = {}
+    for i, subj in enumerate(br_subjects):
+        subj_idx.setdefault(subj[1:-1], i)
+    # Subject names to their positions, filled as the names are met.
+    name_idx = {}
+
+    if starts is None:
+        starts = [i for i, line in enumerate(in_content)
+                    if line.lstrip().startswith('SEM.:')]
+    ends = starts[1:] + [len(in_content)]
+    for row, (start, end) in enumerate(zip(starts, ends)[:PRN_len]):
+        taken = set()
+        for line in in_content[start:end]:
+            for code, s_name, head, int_m, th_m, mark in _tokens12(line):
+                idx = name_idx.get(s_name)
+                if idx is None:
+                    idx = name_idx[s_name] = subj_idx.get(re.escape(s_name),
+                                                        -1)
+                    if idx < 0 and unknown is not None:
+                        unknown.add(code)
+                if idx < 0:
+                    continue
+                pos = row*row_len + idx*width
+                if idx not in taken:
+                    taken.add(idx)
+                    cells[pos:pos+width] = [0]*width
+                cells[pos + _HEAD_IDX[head]] = mark
+                if head == 'PP':
+                    cells[pos+4] = int_m
+                    cells[pos+5] = th_m
+
+    return cells, row_len
+
+def _tokens12(line):
+    """
+    Tokenizes a 2012 pattern mark line. Returns a (code, subject, head,
+    internal, theory, total) tuple for each of its columns. Internal and
+    theory marks are only there for PP. Marks which couldn't be read,
+    such as '--' of a failed head and 'AB' or 'AA' of an absent student,
+    are 'nan'.
+    """
+
+    tokens = []
+    # The text ahead of the first column, then the code, subject, head
+    # and the text up to the next column of each column.
+    pieces = _col12_re.split(line)
+    for col in range(1, len(pieces), 4):
+        code, s_name, head, rest = pieces[col:col+4]
+        # Marks obtained, followed by the P/F result and C of a carry
+        # over.
+        marks = []
+        for field in rest.split():
+            if field == 'P' or field == 'F':
+                break
+            mark = _marks12.get(field)
+            if mark is None:
+                mark = _marks12[field] = _mark12(field)
+            marks.append(mark)
+        if head == 'PP':
+            # The internal marks are left blank when there are none.
+            marks = [_NAN]*(3 - len(marks)) + marks[-3:]
+            tokens.append((code, s_name, head, marks[0], marks[1],
+                           marks[2]))
+        else:
+            tokens.append((code, s_name, head, None, None,
+                           marks[-1] if marks else _NAN))
+
+    return tokens
+
+def _mark12(field):
+    """
+    A mark of a 2012 pattern mark line as a number. Marks may carry a
+    sign such as '$' or '#' for marks given under an ordinance. 'nan'
+    for marks which aren't numbers.
+    """
+
+    digits = field.rstrip('$#*@!')
+    if digits.isdigit():
+        return int(digits)
+    return _NAN
+
+def _learnOffsets(layout, line):
+    """
+    Tokenizes a stripped mark line with the regex and learns the offsets
+    (code start, head start, marks end) of its columns into layout, the
+    most recent first. pdftotext shifts the columns by a character or
+    two between pages, so a few offsets are kept for each column.
+    Returns the tokens.
+    """
+
+    tokens = []
+    for col, tok in enumerate(_markTok_re.finditer(line)):
+        tokens.append(tok.groups())
+        # Columns whose marks can't be read tell nothing of the layout.
+        if tok.group(4) is None:
+            continue
+        if col == len(layout):
+            layout.append([])
+        col_offsets = layout[col]
+        col_offsets.insert(0, (tok.start(1), tok.start(3), tok.end(4)))
+        del col_offsets[_LAYOUT_OFFSETS:]
+
+    return tokens
+
+def _sliceMarks(line, layout, seen):
+    """
+    Slices the columns of a stripped mark line at the offsets in layout.
+    Returns the same tokens _markTok_re.findall would, or None if the
+    line doesn't fit the layout and should be tokenized by the regex.
+
+    Each column is cut into the gap ahead of it, the code and name, and
+    the head and marks. The same pieces recur from student to student,
+    so each distinct piece is checked once and remembered in seen, a
+    tuple of three dicts.
+    """
+
+    gaps, names, marks = seen
+    tokens = []
+    prev = 0
+    for col_offsets in layout:
+        for code_s, head_s, mark_e in col_offsets:
+            gap = line[prev:code_s]
+            gap_ok = gaps.get(gap)
+            if gap_ok is None:
+                gap_ok = gaps[gap] = (len(gap.translate(None, _CODE_CHARS))
+                                        == len(gap))
+            if not gap_ok:
+                continue
+            seg = line[code_s:head_s]
+            name = names.get(seg)
+            if name is None:
+                name = names[seg] = _checkName(seg)
+            if not name:
+                continue
+            seg = line[head_s:mark_e+1]
+            mark = marks.get(seg)
+            if mark is None:
+                mark = marks[seg] = _checkMarks(seg)
+            if mark:
+                break
+        else:
+            # No more columns on this line, or one which doesn't fit.
+            rest = line[prev:]
+            if len(rest.translate(None, _CODE_CHARS)) != len(rest):
+                return None
+            return tokens
+        tokens.append(name + mark)
+        prev = mark_e
+
+    tail = line[prev:]
+    if len(tail.translate(None, _CODE_CHARS)) != len(tail):
+        return None
+
+    return tokens
+
+def _checkName(seg):
+    """
+    Checks a piece of a mark line running from the subject code up to
+    the head. Returns the (code, name) the regex would find in it or
+    False.
+    """
+
+    if seg[:2].isdigit() and len(seg) > 2 and (seg[2].isdigit() or
+            'A' <= seg[2] <= 'Z') and seg[3:].lstrip()[:1] == '.':
+        code = seg[:3]
+    elif seg[:2].isdigit() and seg[2:].lstrip()[:1] == '.':
+        code = seg[:2]
+    else:
+        return False
+
+    s_name = seg[len(code):].lstrip()[1:]
+    if not s_name.strip() or s_name.translate(None, _NAME_CHARS):
+        return False
+    return (code, s_name)
+
+def _checkMarks(seg):
+    """
+    Checks a piece of a mark line running from the head to the
+    character following the marks obtained. Returns the (head, marks)
+    the regex would find in it or False.
+    """
+
+    head = seg[:2]
+    if head not in _HEAD_IDX or not seg[2:3].isspace() or \
+            not seg[-1:].isspace():
+        return False
+
+    # Max marks, min marks and marks obtained.
+    fields = seg[2:-1].split()
+    if len(fields) != 3:
+        return False
+    max_m, min_m, mark = fields
+    # Max marks always hold a digit which ends the subject name.
+    if not (max_m == '100' or (len(max_m) == 2 and max_m.isdigit() and
+            max_m.translate(None, '123'))):
+        return False
+    if not (len(min_m) == 2 and min_m.isdigit()):
+        return False
+    if not (len(mark) == 2 and (mark.isdigit() or ('A' <= mark[0] <= 'Z'
+            and 'A' <= mark[1] <= 'Z'))):
+        return False
+    return (head, mark)
 
 def _mergeMarks(slist, m_factor):
     """
@@ -359,20 +1028,35 @@ def _mergeMarks(slist, m_factor):
 def getSubjects(in_content, examPat):
     """
     Finds subjects and infers the nature (elective/compulsory) of
-    the subjects. Only handles 2008 pattern marks at present.
+    the subjects. Electives of 2012 pattern files can't be told apart
+    by their codes; each is a subject of its own.
     """
 
     err_msg = ("%s expected argument of type 'list','str'; %s,%s given" %
                 (inspect.stack()[0][3], type(in_content), type(examPat)))
     assert (type(in_content) is list and type(examPat) is str), err_msg
 
-    # Only handles 2008 pattern files for now.
-    if examPat != '2008':
+    if examPat not in ('2008', '2012'):
         return []
 
     # Lower level function actually getting the subjects and
     # subject codes.
-    subjects = getSubjDict(in_content, examPat)
+    return _groupSubjects(getSubjDict(in_content, examPat), examPat)
+
+def _groupSubjects(subjects, examPat='2008'):
+    """
+    Builds the list of subject regexes from the dict returned by
+    getSubjDict. Electives sharing a slot are grouped as alternations.
+    2012 pattern subjects are kept in the order of their codes.
+    """
+
+    if examPat == '2012':
+        grouped = []
+        for s_key in sorted(subjects):
+            subj = '(' + re.escape(subjects[s_key]) + ')'
+            if subj not in grouped:
+                grouped.append(subj)
+        return grouped
 
     # Find mandatory subjects
     mandatory = []
@@ -418,28 +1102,26 @@ def getSubjDict(in_content, examPat):
                 (inspect.stack()[0][3], type(in_content), type(examPat)))
     assert (type(in_content) is list and type(examPat) is str), err_msg
 
-    # Only handles 2008 pattern files for now.
-    if examPat != '2008':
-        return []
+    return scanContent(in_content, examPat, ('subjDict',))['subjDict']
 
-    subj_re = (r'((?:[0-9]{3}|[0-9]{2}[A-Z]{1}|[0-9]{2})\s*\.\s*'
-                    r'[-A-Z1-3\s\.&\(\)\,\/]+)\s*(?=PP|PR|OR|TW)')
-    subjects = []
-    for line in in_content:
-        ret_obj = re.findall(subj_re, line)
-        if ret_obj != []:
-            ret_obj = [s.strip() for s in ret_obj]
-            [subjects.append(s_i) for s_i in ret_obj if s_i not in subjects]
+def _splitSubjects(subjects):
+    """
+    Split subject code and the subject name in list of subjects and
+    make a dict out of it.
+    """
 
-    # Split subject code and the subject name in list of subjects
-    subj_code_re = (r'^([0-9]{3}|[0-9]{2}[A-Z]{1}|[0-9]{2})\s*\.\s*'
-                            r'([-A-Z1-3\s\.&\(\)\,\/]+)$')
-    subjects = [re.findall(subj_code_re, s_i) for s_i in subjects]
+    return dict(_subjectPairs(subjects))
 
-    # Flatten 'subjects' to make a dict out of it.
-    subjects = dict([s_pair for sublist in subjects for s_pair in sublist])
+def _subjectPairs(subjects):
+    """
+    Split subject code and the subject name in list of subjects.
+    Returns the list of (code, subject) pairs.
+    """
 
-    return subjects
+    subjects = [_subj_code_re.findall(s_i) for s_i in subjects]
+
+    # Flatten 'subjects' to make a dict out of it.
+    return [s_pair for sublist in subjects for s_pair in sublist]
 
 def makeAbbr(in_str):
     """
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""
+Generates synthetic result sheet text files in the layout pdftotext
+gives for the real results. Used to measure how the conversion scales
+with the size of the input; the samples are far too small for that.
+Both the 2008 and the 2012 exam patterns are generated, with electives,
+grace marks, absentees and F-ATKT totals, over one or more branches.
+"""
+
+import sys
+import random
+import argparse
+
+
+# Branches as (name, number, mandatory subjects, elective slots). A
+# subject is (code, name, heads) and a head is (head, max, min). An
+# elective slot is a list of alternative subjects for the same slot.
+_HEADS_TH = (('PP', 100, 40), ('TW', 25, 10), ('OR', 50, 20))
+_HEADS_PP = (('PP', 100, 40), ('TW', 25, 10))
+_HEADS_LAB = (('TW', 50, 20), ('PR', 50, 20))
+_HEADS_PROJ = (('TW', 100, 40), ('OR', 50, 20))
+
+BRANCHES_08 = [
+    ('CIVIL', '31', [
+        ('010', 'ENVIRONMENTAL ENGINEERING II', _HEADS_TH),
+        ('020', 'DAMS AND HYDRAULIC STRUCTURE', _HEADS_TH),
+        ('030', 'STRUCTURAL DESIGN III', _HEADS_TH),
+        ('080', 'QTY SURVEYING,CONTR. & TENDER', _HEADS_TH),
+        ('090', 'TRANSPORTATION ENGINEERING II', _HEADS_TH),
+        ('100', 'PROJECT WORK', _HEADS_PROJ)], [
+        [('04B', 'SYSTEMS APPROACH IN CIVIL ENGG', _HEADS_PP),
+         ('04D', 'ARCHITECTURE AND TOWN PLANNING', _HEADS_PP)],
+        [('05C', 'TQM & MIS IN CIVIL ENGINEERING', _HEADS_PP[:1]),
+         ('05E', 'ADVANCED CONCRETE TECHNOLOGY', _HEADS_PP[:1])],
+        [('07B', 'ADVANCED TRANSPORTATION ENGG.', _HEADS_PP[:1]),
+         ('07E', 'GEOINFORMATICS', _HEADS_PP[:1])]]),
+    ('MECHANICAL', '32', [
+        ('010', 'CAD/CAM AUTOMATION', _HEADS_LAB[::-1] + _HEADS_PP[:1]),
+        ('020', 'DYNAMICS OF MACHINERY', _HEADS_TH),
+        ('030', 'INDUSTRIAL FLUID POWER', _HEADS_TH),
+        ('060', 'PROJECT WORK', _HEADS_PROJ[:1]),
+        ('070', 'POWER PLANT ENGINEERING', _HEADS_PP),
+        ('080', 'MECHANICAL SYSTEM DESIGN', _HEADS_PP)], [
+        [('04A', 'ENERGY AUDIT AND MANAGEMENT', _HEADS_PP[:1]),
+         ('04B', 'AUTOMOBILE ENGINEERING', _HEADS_PP[:1])],
+        [('05A', 'ERGO. & HUMAN FACTORS IN ENGG', _HEADS_PP[:1]),
+         ('05D', 'PRODUCT DEVELOPMENT', _HEADS_PP[:1])]]),
+    ('COMPUTER', '42', [
+        ('010', 'DESIGN AND ANALY. OF ALGORITHMS', _HEADS_PP[:1]),
+        ('020', 'PRINCIPLES OF COMPILER DESIGN', _HEADS_PP[:1]),
+        ('030', 'OBJECT ORIENTED MODELING & DES.', _HEADS_TH),
+        ('060', 'COMPUTER LABORATORY I', _HEADS_LAB),
+        ('070', 'PROJECT WORK', _HEADS_PROJ[:1])], [
+        [('04A', 'ADVANCE DATABASE MANAGEMENT', _HEADS_PP[:1]),
+         ('04B', 'ARTIFICIAL INTELLIGENCE', _HEADS_PP[:1]),
+         ('04D', 'SOFTWARE ARCHITECTURE', _HEADS_PP[:1])],
+        [('05B', 'MOBILE COMPUTING', _HEADS_PP[:1]),
+         ('05D', 'SOFTWARE TESTING & QUALITY ASSU', _HEADS_PP[:1])]]),
+    ('INFORMATION TECHNOLOGY', '60', [
+        ('010', 'INFO ASSURANCE & SECURITY', _HEADS_PP[:1]),
+        ('020', 'OBJECT ORIEN. MODELING & DESIGN', _HEADS_PP[:1]),
+        ('030', 'SOFTWARE TESTING & QUALITY ASSU', _HEADS_PP[:1]),
+        ('060', 'COMPUTER LAB PRACTICES I', _HEADS_LAB),
+        ('070', 'PROJECT WORK', _HEADS_PROJ)], [
+        [('04A', 'DIGITAL IMAGE PROCESSING', _HEADS_PP[:1]),
+         ('04D', 'SOFTWARE ARCHITECTURE', _HEADS_PP[:1])],
+        [('05B', 'MOBILE COMPUTING', _HEADS_PP[:1]),
+         ('05D', 'MOBILE COMMUNICATION', _HEADS_PP[:1])]]),
+    ]
+
+BRANCHES_12 = [
+    ('CIVIL', '31', [
+        ('301001', 'HYD & WAT RES ENGI', (('PP', 100, 40),)),
+        ('301002', 'INFRASTRUCT ENGINE', (('PP', 100, 40),)),
+        ('301003', 'STRUCTURAL DESIGN I', (('OR', 50, 20), ('PP', 100, 40),
+                                           ('TW', 50, 20))),
+        ('301004', 'STRUCT ANALYSIS II', (('PP', 100, 40),)),
+        ('301005', 'FLUID MECHANICS - II', (('OR', 50, 20), ('PP', 100, 40),
+                                            ('TW', 50, 20))),
+        ('301006', 'EMPLOY SKILL DEVEL', (('TW', 50, 20),)),
+        ('301007', 'ADVANCED SURVEYING', (('OR', 50, 20), ('PP', 100, 40))),
+        ('301008', 'PRO MGMT & ENGI ECO', (('PP', 100, 40),)),
+        ('301009', 'FOUNDA ENGI', (('PP', 100, 40),)),
+        ('301011', 'ENVIRON ENGI - I', (('PP', 100, 40), ('PR', 50, 20))),
+        ('301012', 'SEM & TECH COMM', (('TW', 50, 20),))], []),
+    ('MECHANICAL', '32', [
+        ('302041', 'DESIGN OF MACH EL-I', (('PP', 100, 40), ('OR', 50, 20))),
+        ('302042', 'HEAT TRANSFER', (('PP', 100, 40), ('PR', 50, 20))),
+        ('302043', 'THEORY OF MACHINE-II', (('PP', 100, 40), ('TW', 25, 10))),
+        ('302044', 'TURBO MACHINES', (('PP', 100, 40), ('OR', 50, 20))),
+        ('302045', 'METROLOGY & QLTY CTL', (('PP', 100, 40), ('PR', 50, 20))),
+        ('302046', 'MECHATRONICS', (('PP', 100, 40), ('TW', 25, 10))),
+        ('302047', 'SEM & TECH COMM', (('TW', 50, 20),))], []),
+    ('COMPUTER', '42', [
+        ('310241', 'THEORY OF COMPUTATN', (('PP', 100, 40),)),
+        ('310242', 'DATABASE MANA SYSTM', (('PP', 100, 40), ('PR', 50, 20))),
+        ('310243', 'COMPUTER NETWORKS', (('PP', 100, 40), ('TW', 50, 20))),
+        ('310244', 'OPERATING SYSTEMS', (('PP', 100, 40), ('OR', 50, 20))),
+        ('310245', 'SOFTWARE ENGG', (('PP', 100, 40),)),
+        ('310246', 'PROG LAB - I', (('PR', 50, 20), ('TW', 50, 20))),
+        ('310247', 'SEM & TECH COMM', (('TW', 50, 20),))], []),
+    ]
+
+_PATTERNS = {'2008': BRANCHES_08, '2012': BRANCHES_12}
+_DOTS = ' '.join('.' * 66)
+_DOTS12 = '.' * 131
+
+
+def _obtained(rand, h_max, h_min, absent):
+    """
+    Returns the marks obtained for a head, or 'AB' when absent, and
+    whether the head was passed.
+    """
+
+    if rand.random() < absent:
+        return 'AB', False
+    marks = int(rand.triangular(h_min * 0.8, h_max, h_min * 1.4))
+    marks = min(marks, h_max - 1)
+    return '%02d' % marks, marks >= h_min
+
+def _studentRows(rand, mandatory, electives, absent):
+    """
+    Picks the subjects a student took and the marks obtained in each of
+    their heads. Returns the rows as (code, name, head, max, min,
+    obtained, passed) tuples, the total and the maximum total.
+    """
+
+    subjects = list(mandatory)
+    for slot in electives:
+        subjects.append(rand.choice(slot))
+    subjects.sort()
+
+    rows = []
+    total = 0
+    total_max = 0
+    for code, name, heads in subjects:
+        for head, h_max, h_min in heads:
+            obt, passed = _obtained(rand, h_max, h_min, absent)
+            rows.append((code, name, head, h_max, h_min, obt, passed))
+            total += int(obt) if passed else 0
+            total_max += h_max
+
+    return rows, total, total_max
+
+def _result(total, total_max, failed):
+    """
+    The class awarded for a total.
+    """
+
+    if failed:
+        return 'FAILS'
+    frac = float(total) / total_max
+    if frac >= 0.66:
+        return 'FIRST CLASS WITH DISTINCTION'
+    elif frac >= 0.6:
+        return 'FIRST CLASS'
+    elif frac >= 0.55:
+        return 'HIGHER SECOND CLASS'
+    return 'SECOND CLASS'
+
+def _pageHead08(br_name, year, exDate, page):
+    """
+    Page header lines of a 2008 pattern sheet.
+    """
+
+    return ['%sSAVITRIBAI PHULE PUNE UNIVERSITY, RESULT SHEET FOR %s(2008'
+            ' PAT.)(%s) EXAMINATION %s' % (' ' * 19, year, br_name, exDate),
+            '     DATE : 18 JULY 2015                  CENTRE : D.Y. PATIL'
+            ' COLLEGE OF ENGINEERING,      PUNE                       PAGE'
+            ' NO.    %02d      (%7d)' % (page % 100, page),
+            _DOTS,
+            '  NOTE: FIRST LINE : SEAT NO.,    NAME OF THE CANDIDATE,     '
+            'MOTHER, PERMANENT REG. NO.,    PREVIOUS SEAT NO.,   COLLEGE, '
+            '       SEAT NO.',
+            '        OTHER LINES: HEAD OF PASSING,     MAX. MARKS,   MIN. '
+            'PASS MARKS,    MARKS OBTAINED,   P/F:PASS/FAIL,   C: PREVIOUS '
+            'CARRY OVER',
+            _DOTS,
+            '                     MAX.MARKS : 1500    DISTINCTION : 0990    '
+            'FIRST CLASS : 900   HIGHER II CL: 825    SECOND CLASS: 750 '
+            'PASS CLASS: 600']
+
+def _pageHead12(br_name, br_num, year, exDate, page):
+    """
+    Page header lines of a 2012 pattern sheet.
+    """
+
+    return ['%sSAVITRIBAI PHULE PUNE UNIVERSITY, %s(2012 COURSE)EXAMINATION,'
+            ' APRIL/%s' % (' ' * 34, year, exDate),
+            '     BRANCH: %s %s(2012 PAT.)(%s)' % (br_num, year, br_name),
+            '     DATE : 25 JULY 2015         CENTRE: D.Y. PATIL COLLEGE OF'
+            ' ENGINEERING,     PUNE                         PAGE NO. %d' %
+            page,
+            _DOTS12,
+            '   NOTE: FIRST LINE : SEAT NO.,     NAME OF THE CANDIDATE,   '
+            'MOTHER, PERMANENT REG. NO.,      PREVIOUS SEAT NO.,    COLLEGE,'
+            '    SEAT NO.',
+            '  OTHER LINES: HEAD OF PASSING,     MAX. MARKS, MIN.PASS MARKS,'
+            ' INT. MARKS, TH. MARKS, TOTAL MARKS OBTAINED,         '
+            'P/F:PASS/FAIL,   C:PREVIOUS CARRY OVER',
+            _DOTS12]
+
+def _student08(rand, prn, college, mandatory, electives, absent, grace):
+    """
+    Lines of one student of a 2008 pattern sheet.
+    """
+
+    rows, total, total_max = _studentRows(rand, mandatory, electives, absent)
+    failed = not all(row[6] for row in rows)
+
+    cols = []
+    for code, name, head, h_max, h_min, obt, passed in rows:
+        cols.append('%s . %-32s %s  %4d %4d    %2s   %s %s' % (code, name,
+                    head, h_max, h_min, obt, 'P' if passed else 'F',
+                    'C' if rand.random() < 0.8 else ' '))
+    half = (len(cols) + 1) // 2
+    lines = ['  B%08d  STUDENTS NAME     MOTHERS NAME  ,  %s      ,       '
+             '     ,     %-18s,' % (rand.randint(0, 99999999), prn, college)]
+    for idx in range(half):
+        right = cols[half + idx] if half + idx < len(cols) else ''
+        lines.append(('    %s     %s' % (cols[idx], right)).rstrip())
+
+    if not failed and rand.random() < grace:
+        total_str = '%5d+%02d' % (total, rand.randint(1, 9))
+    else:
+        total_str = '%5d' % total
+    lines.append('GRAND TOTAL = %s/%d, RESULT: %s' % (total_str, total_max,
+                _result(total, total_max, failed)))
+    lines.append(_DOTS)
+    return lines
+
+def _student12(rand, prn, college, mandatory, electives, absent, grace):
+    """
+    Lines of one student of a 2012 pattern sheet.
+    """
+
+    rows, total, total_max = _studentRows(rand, mandatory, electives, absent)
+    failed = not all(row[6] for row in rows)
+
+    cols = []
+    for code, name, head, h_max, h_min, obt, passed in rows:
+        if head == 'PP' and obt != 'AB':
+            split = rand.randint(0, min(int(obt), 30))
+            inth = '%-4d %-6d' % (split, int(obt) - split)
+        else:
+            inth = ' ' * 11
+        cols.append('%s   %-30s  %s %4d %2d    %s %3s %s %s' % (code, name,
+                    head, h_max, h_min, inth, obt if passed else '--',
+                    'P' if passed else 'F',
+                    'C' if rand.random() < 0.8 else ' '))
+    half = (len(cols) + 1) // 2
+    seat = 'T%09d' % rand.randint(0, 999999999)
+    lines = ['   %s  STUDENTS NAME     MOTHERS NAME  ,  %s     ,%-17s,%s' %
+             (seat, prn, college, seat), '', '',
+             '    SEM.:1%sSEM.:2' % (' ' * 69)]
+    for idx in range(half):
+        right = cols[half + idx] if half + idx < len(cols) else ''
+        lines.append(('  %s   %s' % (cols[idx], right)).rstrip())
+
+    if failed:
+        lines.append('GRAND TOTAL = --/%d    , Result : FAILS A.T.K.T.' %
+                     total_max)
+    else:
+        if rand.random() < grace:
+            total_str = '%d + %02d' % (total, rand.randint(1, 9))
+        else:
+            total_str = '%d' % total
+        lines.append('GRAND TOTAL = %s/%d    , Result : %s' % (total_str,
+                     total_max, _result(total, total_max, failed)))
+    lines.append(_DOTS12)
+    return lines
+
+def genLines(examPat, students, branches=None, year=None, college='COLNAME',
+        exDate='MAY 2015', seed=0, absent=0.01, grace=0.05, perPage=3):
+    """
+    Yields the lines of a synthetic result sheet, one line at a time, so
+    sheets of any size can be written without holding them in memory.
+    Arguments:
+            examPat: Pattern of exam. 2008 or 2012.
+            students: Number of students in the sheet. They're spread
+                    evenly over the branches.
+            branches: Number of branches in the sheet. All the known
+                    branches of examPat when None.
+            year: Year of the students, like 'B.E.'. Defaults to B.E.
+                    for 2008 and T.E. for 2012 like the samples.
+            college: College abbreviation on the student header lines.
+            exDate: Month and year of the exam.
+            seed: Seed for the random numbers, so sheets can be remade.
+            absent: Chance that a student is absent for a head.
+            grace: Chance that a student who passed got grace marks.
+            perPage: Number of students on each page.
+    """
+
+    err_msg = ("genLines expected examPat of '2008' or '2012'; %s given" %
+                examPat)
+    assert examPat in _PATTERNS, err_msg
+
+    rand = random.Random(seed)
+    br_all = _PATTERNS[examPat]
+    br_all = br_all[:branches] if branches else br_all
+    if year is None:
+        year = 'B.E.' if examPat == '2008' else 'T.E.'
+
+    prn = 0
+    page = 0
+    for br_idx, (br_name, br_num, mandatory, electives) in enumerate(br_all):
+        br_students = students // len(br_all)
+        if br_idx < students % len(br_all):
+            br_students += 1
+        for st_idx in range(br_students):
+            if st_idx % perPage == 0:
+                page += 1
+                if examPat == '2008':
+                    head = _pageHead08(br_name, year, exDate, page)
+                else:
+                    head = _pageHead12(br_name, br_num, year, exDate, page)
+                for line in head:
+                    yield line
+            prn += 1
+            prn_str = '%08d%s' % (prn, chr(ord('A') + prn % 26))
+            if examPat == '2008':
+                lines = _student08(rand, prn_str, college, mandatory,
+                                electives, absent, grace)
+            else:
+                lines = _student12(rand, prn_str, college, mandatory,
+                                electives, absent, grace)
+            for line in lines:
+                yield line
+
+def genFile(out_filename, examPat, students, **kwargs):
+    """
+    Writes a synthetic result sheet to out_filename. Takes the same
+    arguments as genLines.
+    """
+
+    out_file = open(out_filename, 'w')
+    try:
+        for line in genLines(examPat, students, **kwargs):
+            out_file.write(line)
+            out_file.write('\n')
+    finally:
+        out_file.close()
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('out_filename',
+            help="Path to the text file to write. '-' writes to stdout.")
+
+    parser.add_argument('-n', '--students', type=int, default=1000,
+            help='Number of students in the sheet.')
+
+    parser.add_argument('-t', '--pattern', choices=sorted(_PATTERNS),
+            default='2008', help='Exam pattern of the sheet.')
+
+    parser.add_argument('-r', '--branches', type=int, default=None,
+            help='Number of branches in the sheet. Defaults to all the'
+            ' branches known for the pattern.')
+
+    parser.add_argument('--seed', type=int, default=0,
+            help='Seed for the random numbers.')
+
+    parser.add_argument('--absent', type=float, default=0.01,
+            help='Chance that a student is absent for a head of passing.')
+
+    parser.add_argument('--grace', type=float, default=0.05,
+            help='Chance that a student who passed gets grace marks.')
+
+    clargs = parser.parse_args()
+    gen_args = dict(branches=clargs.branches, seed=clargs.seed,
+                    absent=clargs.absent, grace=clargs.grace)
+
+    if clargs.out_filename == '-':
+        for line in genLines(clargs.pattern, clargs.students, **gen_args):
+            sys.stdout.write(line + '\n')
+        return
+
+    try:
+        genFile(clargs.out_filename, clargs.pattern, clargs.students,
+                **gen_args)
+    except IOError as ioe:
+        sys.stderr.write('IO ERROR (%d): %s: %s\n' % (ioe.errno,
+                        ioe.strerror, clargs.out_filename))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
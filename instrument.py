@@ -0,0 +1,149 @@
+"""
+Timers and counters for the stages of building the outputs. A Profile
+is kept for each input file and one for each of its branches, and is
+written out as a JSON report. A NullProfile stands in when profiling
+isn't asked for so the code being timed needn't check.
+"""
+
+import json
+import time
+import contextlib
+
+
+class Profile(object):
+    """
+    Times spent in the stages of building an input file or a branch,
+    and counts of things seen while at it. A stage may be timed more
+    than once; the times add up.
+
+    Attributes: name, stages, order, counters, branches
+    """
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.order = []
+        self.counters = {}
+        self.branches = []
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """
+        Adds the time spent in the with block to stage.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            if stage not in self.stages:
+                self.stages[stage] = 0.0
+                self.order.append(stage)
+            self.stages[stage] += time.time() - start
+
+    def timedIter(self, iterable, stage):
+        """
+        Yields the items of iterable, adding the time spent getting each
+        of them to stage. For timing lazy readers.
+        """
+
+        in_iter = iter(iterable)
+        while True:
+            with self.timed(stage):
+                try:
+                    item = next(in_iter)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, counter, n=1):
+        """
+        Adds n to counter.
+        """
+
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def child(self, name):
+        """
+        Returns a new profile of the same kind, for a branch.
+        """
+
+        return self.__class__(name)
+
+    def addBranch(self, brProf):
+        """
+        Adds the profile of a branch. Its counters are added to those of
+        this profile too.
+        """
+
+        self.branches.append(brProf)
+        for counter, n in brProf.counters.items():
+            self.count(counter, n)
+
+    def report(self):
+        """
+        Returns the profile as a dict which can be written as JSON.
+        Branch stage times are summed up in branch_stages.
+        """
+
+        branch_stages = {}
+        for brProf in self.branches:
+            for stage, seconds in brProf.stages.items():
+                branch_stages[stage] = branch_stages.get(stage, 0.0) + \
+                                    seconds
+        rep = {'name': self.name, 'stages': self.stages,
+               'counters': self.counters}
+        if self.branches:
+            rep['branch_stages'] = branch_stages
+            rep['branches'] = [brProf.report() for brProf in self.branches]
+        return rep
+
+    def timingLine(self):
+        """
+        The stage times on one line, in the order first timed.
+        """
+
+        return 'Time (s): ' + ', '.join('%s %.3f' % (stage,
+                                        self.stages[stage])
+                                        for stage in self.order)
+
+    def write(self, out_filename):
+        """
+        Writes the report to out_filename as JSON.
+        """
+
+        out_file = open(out_filename, 'w')
+        try:
+            json.dump(self.report(), out_file, indent=2, sort_keys=True)
+        finally:
+            out_file.close()
+
+
+class NullProfile(Profile):
+    """
+    A Profile which keeps nothing.
+    """
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        yield
+
+    def timedIter(self, iterable, stage):
+        return iterable
+
+    def count(self, counter, n=1):
+        pass
+
+    def addBranch(self, brProf):
+        pass
+
+
+def forArgs(clargs, name):
+    """
+    Returns a Profile if clargs ask for profiling in any form, and a
+    NullProfile otherwise.
+    """
+
+    if (getattr(clargs, 'profile', None) or getattr(clargs, 'timings', False)
+            or getattr(clargs, 'cprofile', False)):
+        return Profile(name)
+    return NullProfile(name)
@@ -2,7 +2,9 @@
 """
 Higher level functions which call the lower level data get functions,
 provide some control on nature of output generated and generate the
-output.
+output. convert is the interface for other code; it prints nothing,
+returns a BranchResult per branch and raises ConvError. The command
+line is a thin layer over it.
 """
 
 import os
@@ -11,12 +13,245 @@ import errno
 import argparse
 import re
 import csv
+import itertools
+import collections
+import multiprocessing
 import string
 import pprint
+import StringIO
+import traceback
+import gzip
+import cStringIO
+import cProfile
+import hashlib
+import json
+import tempfile
+import sqlite3
+import mmap
+import thread
+import threading
+import Queue
+import signal
 import extractData as exDt
+import instrument
+import subjCatalog
+import colStore
+import sqlSink
+import studentStore
 
-#TODO: Consider defining your own exceptions and using them instead of
-# printing to stderr manually.
+# zstd compression of the outputs is optional.
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# This is unnecessarily complex because of a random error they made
+# where they've missed a closing bracket.
+br08_re = re.compile(r'.*PUNE.*\([0-9]{4}\s*PAT.*\)\s*\(([A-Z\.\-&\s]+)(\s|'
+            r'\)).*')
+br12_re = re.compile(r'^BRANCH.*\(([A-Z\.\&\s]+)\)$')
+
+# Bumped when a change to the code changes the outputs, so incremental
+# runs don't keep outputs built by older code.
+_MANIFEST_VERSION = 4
+
+# Rows formatted and written at a time, and the size of the buffer of the
+# output files.
+_WRITE_BATCH = 4096
+_WRITE_BUFFER = 1 << 20
+# Branches built but not yet written a background writer holds at most.
+_WRITE_AHEAD = 2
+_OUT_EXTS = {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+# Output formats.
+FORMATS = ('csv', 'npz', 'parquet')
+
+# Bytes of the input mapped at a time with --mmap, bytes of it split
+# into lines at a time, and the text every branch header line of each
+# exam pattern has in it.
+_MAP_WINDOW = 4 << 20
+_MAP_BLOCK = 1 << 20
+_BR_MARKS = {'2008': 'PUNE', '2012': 'BRANCH'}
+
+# Subject catalog caches, one per cache directory.
+_catalogs = {}
+# SQLite connections, one per database and thread.
+_databases = {}
+
+class ConvError(Exception):
+    """
+    Raised when an input file can't be converted. The message is the
+    line the command line scripts print, and status the exit status
+    they exit with.
+    """
+
+    status = 1
+
+class OptionError(ConvError):
+    """
+    The options ask for something that can't be done, such as a format
+    whose package isn't installed, or aren't options at all.
+    """
+
+    status = 2
+
+class InputError(ConvError):
+    """
+    The input isn't a mark sheet that can be converted.
+    """
+
+    status = 2
+
+class ReadError(InputError):
+    """
+    The input couldn't be read.
+    """
+
+    status = 1
+
+class OutputError(ConvError):
+    """
+    An output couldn't be written.
+    """
+
+    status = 1
+
+class BranchResult(object):
+    """
+    How the build of one branch of an input file went. The warnings
+    and the error are messages without the 'WARNING: ' or 'ERROR: ' the
+    command line puts ahead of them.
+    Attributes:
+            name: Name of the branch in the input.
+            examPat: The exam pattern of the input.
+            header: Dict of the college, year, branch and exDate of the
+                    branch, as extractData.sniffHeader returns it.
+            subjDict: The subjects found, or None if none were looked
+                    for.
+            details: The details of the branch as printed by the command
+                    line, or None if it wasn't built.
+            students: Number of students, PRNs, in the branch.
+            totals: Number of total marks found.
+            out_fname: Name of the outputs without extension, or None if
+                    the branch couldn't be built.
+            outputs: Paths of the files written.
+            records: The students of the branch formatted as --stdout
+                    asks, or None.
+            branch: The students of the branch as a
+                    studentStore.CompactBranch when the keep option is
+                    set, or None.
+            misaligned: Whether PRNs and marks may be misaligned.
+            padded_rows: Rows padded with missing totals.
+            unchanged: Whether the branch was skipped as unchanged since
+                    the last incremental run.
+            warnings: List of warnings.
+            error: Why the branch couldn't be built, or None.
+            profile: The instrument profile of the branch.
+    """
+
+    def __init__(self, name, examPat=None, out_fname=None, unchanged=False,
+            profile=None):
+        self.name = name
+        self.examPat = examPat
+        self.header = None
+        self.subjDict = None
+        self.details = None
+        self.students = 0
+        self.totals = 0
+        self.out_fname = out_fname
+        self.outputs = []
+        self.records = None
+        self.branch = None
+        self.misaligned = False
+        self.padded_rows = 0
+        self.unchanged = unchanged
+        self.warnings = []
+        self.error = None
+        self.profile = profile
+
+    def __repr__(self):
+        return '<BranchResult %s: %s>' % (self.name, self.error or
+                                          self.out_fname)
+
+class BackgroundWriter(object):
+    """
+    Writes the outputs of branches on a thread of its own, so the next
+    branch is extracted while the last one is written. Results are
+    submitted in file order and come out of finished and drain in that
+    order once written; results with nothing to write are submitted too
+    so they keep their place. Submitting blocks while depth branches
+    wait to be written. An error writing a branch is raised when its
+    result comes out, and the branches after it aren't written.
+    """
+
+    def __init__(self, depth=_WRITE_AHEAD):
+        self._jobs = Queue.Queue(depth)
+        self._pending = collections.deque()
+        self._failed = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, result, br=None, clargs=None, outDir=None):
+        """
+        Queues the outputs of a branch for writing, as writeOut would
+        write them. Without br the result is only passed through.
+        """
+
+        job = {'result': result, 'write': (br, clargs, result.out_fname,
+               outDir) if br is not None else None, 'error': None,
+               'done': threading.Event()}
+        self._pending.append(job)
+        self._jobs.put(job)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                if job['write'] is not None and not self._failed.is_set():
+                    with job['result'].profile.timed('write'):
+                        job['result'].outputs = writeOut(*job['write'])
+            except Exception:
+                job['error'] = sys.exc_info()
+                self._failed.set()
+            finally:
+                job['done'].set()
+
+    def _next(self):
+        job = self._pending.popleft()
+        job['done'].wait()
+        if job['error'] is not None:
+            exc_type, exc_value, exc_tb = job['error']
+            raise exc_type, exc_value, exc_tb
+        return job['result']
+
+    def finished(self):
+        """
+        Yields the results written so far, without waiting.
+        """
+
+        while self._pending and self._pending[0]['done'].is_set():
+            yield self._next()
+
+    def drain(self):
+        """
+        Yields the rest of the results as they are written.
+        """
+
+        while self._pending:
+            yield self._next()
+
+    def close(self):
+        """
+        Stops the thread once the branch being written is done. Those
+        still queued aren't written.
+        """
+
+        self._failed.set()
+        self._jobs.put(None)
+        self._thread.join()
 
 def branchBuild(clargs):
     """
@@ -27,84 +262,710 @@ def branchBuild(clargs):
                     arguments
     """
 
-    # It's likely non-text files will be passed to this script.
-    if not istext(clargs.in_filename):
-        sys.stderr.write('ERROR: Input file must be a text file.\n')
-        sys.exit(2)
+    buildFile(clargs)
+    sys.exit(0)
 
+def buildFile(clargs):
+    """
+    Does the work of branchBuild for a single input file; converts it
+    and prints the results of each branch as they come. The input is
+    read from stdin when clargs.in_filename is '-'. Exits on errors
+    which stop the whole file. Returns a list with a (branch name, output
+    file name) tuple for each branch; the output file name is None when
+    the branch could not be built.
+    Arguments:
+            clargs: A argparse.Namespace object with the command line
+                    arguments
+    """
+
+    prof = instrument.forArgs(clargs, clargs.in_filename)
+    prof_dir = getattr(clargs, 'profile', None)
+    if clargs.in_filename == '-':
+        base_name = 'stdin'
+    else:
+        base_name = os.path.basename(clargs.in_filename)
+    if prof_dir:
+        try:
+            colStore.makeDirs(prof_dir)
+        except OSError as ose:
+            sys.stderr.write('OS ERROR (%d): %s: %s\n' % (ose.errno,
+                            ose.strerror, prof_dir))
+            sys.exit(1)
     try:
-        #Check Universal newlines for 'rU'
-        in_file = open(clargs.in_filename, 'rU')
+        if getattr(clargs, 'cprofile', False):
+            cprof = cProfile.Profile()
+            try:
+                built = cprof.runcall(_printFile, clargs, prof)
+            finally:
+                cprof.dump_stats(os.path.join(prof_dir or '.',
+                                            base_name + '.pstats'))
+        else:
+            built = _printFile(clargs, prof)
+    except ConvError as err:
+        sys.stderr.write('%s\n' % err)
+        sys.exit(err.status)
+
+    if prof_dir:
         try:
-            in_content = in_file.readlines()
-        finally:
-            in_file.close()
+            prof.write(os.path.join(prof_dir, base_name + '.profile.json'))
+        except (IOError, OSError) as err:
+            sys.stderr.write('IO ERROR (%d): %s: %s\n' % (err.errno,
+                            err.strerror, prof_dir))
+    if getattr(clargs, 'timings', False):
+        print >>reportStream(clargs), '\n', prof.timingLine()
+
+    return built
+
+def _printFile(clargs, prof):
+    """
+    Converts clargs.in_filename printing each result, and writing the
+    records of each branch to stdout with --stdout. Returns the list
+    buildFile does.
+    """
+
+    source = sys.stdin if clargs.in_filename == '-' else clargs.in_filename
+    built = []
+    # With -H the header of each branch is printed as soon as it's
+    # sniffed, before the marks are extracted.
+    announced = []
+    def _announce(result):
+        printHeader(result, clargs)
+        announced.append(result)
+    onheader = _announce if getattr(clargs, 'printheader', False) else None
+    for result in iterConvert(source, clargs, prof, onheader):
+        printResult(result, clargs, announced=result in announced)
+        del announced[:]
+        if result.records:
+            sys.stdout.write(result.records)
+            # Readers downstream get each branch as soon as it's built.
+            sys.stdout.flush()
+        built.append((result.name, result.out_fname))
+    return built
+
+def reportStream(clargs):
+    """
+    Where the report of each branch is printed; stdout, or stderr when
+    stdout carries the records.
+    """
+
+    return sys.stderr if getattr(clargs, 'stdout', None) else sys.stdout
+
+def printHeader(result, clargs):
+    """
+    Prints the name of the branch of a BranchResult, and its header if
+    clargs asks for it.
+    """
+
+    out = reportStream(clargs)
+    print >>out, '\n', result.name
+    header = result.header
+    if header is not None and getattr(clargs, 'printheader', False):
+        print >>out, ('College abbr: %s\nYear: %s\nBranch abbr: %s\nExam'
+                ' date: %s') % (header['college'], header['year'],
+                header['branch'], header['exDate'])
+
+def printResult(result, clargs, announced=False):
+    """
+    Prints a BranchResult the way the command line options in clargs
+    ask for; the details to stdout, the warnings and error to stderr.
+    The name and header of the branch are left out if announced, as
+    printed by printHeader already.
+    """
+
+    out = reportStream(clargs)
+    if result.unchanged:
+        print >>out, '\n', result.name
+        print >>out, 'Unchanged since last run: %s' % result.out_fname
+        return
+    if not announced:
+        printHeader(result, clargs)
+    # Details are only there for branches which passed the checks.
+    if result.details is not None:
+        if clargs.printsubj == True:
+            pprint.pprint(result.subjDict, out)
+        if clargs.noprintdetail == False:
+            print >>out, result.details
+    for warning in result.warnings:
+        sys.stderr.write('WARNING: %s\n' % warning)
+    if result.error is not None:
+        sys.stderr.write('ERROR: %s\n' % result.error)
+    if getattr(clargs, 'timings', False):
+        print >>out, result.profile.timingLine()
+
+def defaultOptions(**kwargs):
+    """
+    Returns the options of a conversion, the defaults of the command
+    line with those in kwargs changed, as a argparse.Namespace. Raises
+    OptionError for names which aren't options. Besides those of the
+    command line, keep=True keeps the students of each branch in its
+    BranchResult, compactly.
+    For example: defaultOptions(nowriteprn=True, formats=['parquet'])
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    addOutputArgs(parser)
+    options = parser.parse_args([])
+    options.brjobs = 1
+    options.stdout = None
+    options.keep = False
+    for name, value in kwargs.items():
+        if not hasattr(options, name):
+            raise OptionError('ERROR: Unknown option: %s' % name)
+        setattr(options, name, value)
+    return options
+
+def checkOptions(options):
+    """
+    Raises OptionError if the options need a package which isn't
+    installed.
+    """
+
+    if getattr(options, 'columnar', False) and exDt.np is None:
+        raise OptionError('ERROR: --columnar needs NumPy.')
+    if getattr(options, 'compress', None) == 'zstd' and zstd is None:
+        raise OptionError('ERROR: --compress zstd needs zstandard.')
+    formats = getattr(options, 'formats', ['csv'])
+    if ('npz' in formats or 'parquet' in formats) and colStore.np is None:
+        raise OptionError('ERROR: --format npz and parquet need NumPy.')
+    if 'parquet' in formats and colStore.pa is None:
+        raise OptionError('ERROR: --format parquet needs pyarrow.')
+
+def convert(source, options=None, prof=None):
+    """
+    Converts an input file. Nothing is printed; returns a list with a
+    BranchResult for each branch, in file order. Branches which can't be
+    built have their error set; problems which stop the whole file are
+    raised as ConvError.
+    Arguments:
+            source: Path of the input text file, or a stream of its lines.
+            options: argparse.Namespace as returned by defaultOptions or
+                    parsed from the command line, or a dict of options
+                    for defaultOptions. The defaults if None.
+            prof: Optional instrument.Profile the stages are timed in.
+    """
+
+    return list(iterConvert(source, options, prof))
+
+def iterConvert(source, options=None, prof=None, onheader=None):
+    """
+    Does the work of convert, yielding the result of each branch as soon
+    as it's built. The input is read lazily and only the lines of the
+    branch being built are held in memory. Streams are read as text;
+    --mmap and --incremental only apply to paths.
+
+    onheader, if given, is called with the BranchResult of each branch
+    being built as soon as its header is sniffed, before its marks are
+    extracted, and always ahead of the branch's result being yielded.
+    It isn't called with brjobs or bgwrite, whose results don't come in
+    step with the branches being built; the header comes with the
+    result then.
+    """
+
+    if options is None:
+        options = defaultOptions()
+    elif isinstance(options, dict):
+        options = defaultOptions(**options)
+    checkOptions(options)
+    if prof is None:
+        prof = instrument.NullProfile('convert')
+
+    use_map = False
+    if isinstance(source, basestring):
+        in_filename = source
+        # It's likely non-text files will be passed to this script.
+        with prof.timed('istext'):
+            is_text = istext(in_filename)
+        if not is_text:
+            raise InputError('ERROR: Input file must be a text file.')
+        use_map = getattr(options, 'mmap', False)
+        try:
+            #Check Universal newlines for 'rU'
+            in_file = open(in_filename, 'rb' if use_map else 'rU')
+        except IOError as ioe:
+            raise ReadError('IO ERROR (%d): %s: %s' % (ioe.errno,
+                            ioe.strerror, in_filename))
+        in_lines = in_file
+    else:
+        in_filename = getattr(source, 'name', '<stream>')
+        in_file = None
+        with prof.timed('istext'):
+            is_text, in_lines = _peekText(source)
+        if not is_text:
+            raise InputError('ERROR: Input file must be a text file.')
+
+    try:
+        outDir = options.outdir
+        # Nothing is written there when the records go to stdout.
+        if not getattr(options, 'stdout', None):
+            makeOutDir(outDir)
+
+        with prof.timed('sniff'):
+            if use_map:
+                examPat = mapExPat(in_file)
+            else:
+                examPat, in_lines = sniffExPat(in_lines)
+        if examPat == '2008':
+            br_re = br08_re
+        elif examPat == '2012':
+            br_re = br12_re
+        else:
+            raise InputError('ERROR: Can only handle 2008 or 2012 pattern'
+                            ' mark sheets')
+
+        # Incremental runs skip the branches whose section of the input
+        # hasn't changed since the manifest was written.
+        incremental = (getattr(options, 'incremental', False) and
+                    writesFiles(options) and in_file is not None)
+        if incremental:
+            man_fname = os.path.join(outDir, ''.join([
+                        os.path.basename(in_filename), '.manifest']))
+            old_man = loadManifest(man_fname)
+        else:
+            old_man = None
+        new_man = {}
+        keys_seen = set()
+
+        # Build and write outputs for each branch appearing in the input
+        # file.
+        # Reading the input is lazy; it's timed along with the split.
+        if use_map:
+            branches = mapBranches(in_file, examPat, br_re)
+        else:
+            branches = splitBranches(in_lines, br_re)
+        branches = prof.timedIter(branches, 'split')
+        if getattr(options, 'brjobs', 1) > 1:
+            results = _buildParallel(branches, outDir, examPat, options,
+                                prof, old_man, new_man, keys_seen)
+        else:
+            results = _buildSerial(branches, outDir, examPat, options,
+                                prof, old_man, new_man, keys_seen, onheader)
+        for result in results:
+            prof.count('branches')
+            yield result
+
+        if incremental:
+            saveManifest(man_fname, new_man)
     except IOError as ioe:
-        sys.stderr.write('IO ERROR (%d): %s: %s\n' %
-                        (ioe.errno, ioe.strerror, clargs.in_filename))
-        sys.exit(1)
+        raise ReadError('IO ERROR (%d): %s: %s' % (ioe.errno, ioe.strerror,
+                        in_filename))
+    finally:
+        if in_file is not None:
+            in_file.close()
+
+def _peekText(source):
+    """
+    Checks that a stream is text the way istext checks a file, reading
+    about the same amount of it. Returns whether it's text and an
+    iterator over all of its lines.
+    """
+
+    in_lines = iter(source)
+    head = []
+    size = 0
+    for line in in_lines:
+        head.append(line)
+        size += len(line)
+        if size >= 512:
+            break
+    return (isTextBlock(''.join(head)[:512]),
+            itertools.chain(head, in_lines))
+
+def makeOutDir(outDir):
+    """
+    Creates the output directory if it isn't there. Raises OutputError
+    if it can't be.
+    """
 
-    # Create output directory
-    outDir = 'outCSV'
     try:
-        os.makedirs(outDir)
+        colStore.makeDirs(outDir)
     except OSError as ose:
         # For the case of file by name of outDir existing.
-        if not os.path.isdir(outDir) and ose.errno == errno.EEXIST:
-            sys.stderr.write('IO ERROR: Could not create output directory\n')
-        if ose.errno != errno.EEXIST:
-            sys.stderr.write('OS ERROR (%d): %s: %s\n' %
-                            (ose.errno, ose.strerror, outDir))
-        sys.exit(1)
-
-    # This is unnecessarily complex because of a random error they made
-    # where they've missed a closing bracket.
-    br08_re = r'.*PUNE.*\([0-9]{4}\s*PAT.*\)\s*\(([A-Z\.\-&\s]+)(\s|\)).*'
-    br12_re = r'^BRANCH.*\(([A-Z\.\&\s]+)\)$'
-
-    examPat = exDt.getExPat(in_content)
-    if examPat == '2008':
-        br_re = br08_re
-    elif examPat == '2012':
-        br_re = br12_re
+        if ose.errno == errno.EEXIST:
+            raise OutputError('IO ERROR: Could not create output'
+                            ' directory')
+        raise OutputError('OS ERROR (%d): %s: %s' % (ose.errno,
+                        ose.strerror, outDir))
+
+def _buildBranch(in_content, outDir, examPat, options, brProf, br_name,
+        writer=None, onheader=None):
+    """
+    Calls buildOut timing all of it in brProf. Returns the BranchResult,
+    with brProf in it, which workers pass back to the parent this way.
+    """
+
+    with brProf.timed('build'):
+        result = buildOut(in_content, outDir, examPat, options, brProf,
+                        br_name, writer, onheader)
+    result.profile = brProf
+    return result
+
+def _buildSerial(branches, outDir, examPat, options, prof, old_man=None,
+        new_man=None, keys_seen=None, onheader=None):
+    """
+    Builds the branches one after the other. Yields a BranchResult for
+    each. The profiles of the branches are added to prof. Branches
+    unchanged since old_man are skipped, and the built ones recorded in
+    new_man. With options.bgwrite the outputs of each branch are written
+    on a BackgroundWriter while the next one is extracted; the results
+    are yielded once written. onheader is called as iterConvert says,
+    only without a BackgroundWriter.
+    """
+
+    writer = None
+    if getattr(options, 'bgwrite', False):
+        writer = BackgroundWriter()
+        onheader = None
+    keys = {}
+
+    def _done(result):
+        if not result.unchanged:
+            prof.addBranch(result.profile)
+        br_key, br_hash = keys.pop(id(result))
+        if old_man is not None and result.out_fname is not None:
+            new_man[br_key] = {'hash': br_hash,
+                               'out_fname': result.out_fname}
+        return result
+
+    try:
+        for br_name, br_content in branches:
+            br_key, br_hash, out_fname = _checkUnchanged(old_man, keys_seen,
+                        br_name, br_content, examPat, options, outDir)
+            if out_fname is None:
+                result = _buildBranch(br_content, outDir, examPat, options,
+                                prof.child(br_name), br_name, writer,
+                                onheader)
+            else:
+                result = BranchResult(br_name, examPat, out_fname,
+                                    unchanged=True)
+                prof.count('unchanged_branches')
+            keys[id(result)] = (br_key, br_hash)
+            # Release the branch before the next one is read.
+            del br_content
+            if writer is None:
+                yield _done(result)
+                continue
+            # Nothing to write for failed and unchanged branches.
+            if result.unchanged or result.error is not None:
+                writer.submit(result)
+            for result in writer.finished():
+                yield _done(result)
+        if writer is not None:
+            for result in writer.drain():
+                yield _done(result)
+    finally:
+        if writer is not None:
+            writer.close()
+
+def _buildParallel(branches, outDir, examPat, options, prof, old_man=None,
+        new_man=None, keys_seen=None):
+    """
+    Builds the branches over a pool of options.brjobs worker processes.
+    Yields the results in file order, as _buildSerial does, and reads no
+    more than two branches per worker ahead of the one yielded.
+    """
+
+    pool = multiprocessing.Pool(options.brjobs)
+    pending = collections.deque()
+
+    def _next():
+        br_name, br_key, br_hash, out_fname, async_res = pending.popleft()
+        if async_res is None:
+            result = BranchResult(br_name, examPat, out_fname,
+                                unchanged=True)
+            prof.count('unchanged_branches')
+        else:
+            result = async_res.get()
+            prof.addBranch(result.profile)
+        if old_man is not None and result.out_fname is not None:
+            new_man[br_key] = {'hash': br_hash,
+                               'out_fname': result.out_fname}
+        return result
+
+    try:
+        for br_name, br_content in branches:
+            br_key, br_hash, out_fname = _checkUnchanged(old_man,
+                        keys_seen, br_name, br_content, examPat, options,
+                        outDir)
+            if out_fname is not None:
+                async_res = None
+            else:
+                async_res = pool.apply_async(_buildBranch, (br_content,
+                            outDir, examPat, options, prof.child(br_name),
+                            br_name))
+            pending.append((br_name, br_key, br_hash, out_fname, async_res))
+            del br_content
+            if len(pending) >= 2*options.brjobs:
+                yield _next()
+        while pending:
+            yield _next()
+    except:
+        pool.terminate()
+        raise
     else:
-        sys.stderr.write('ERROR: Can only handle 2008 or 2012 pattern mark'
-                        ' sheets\n')
-        sys.exit(2)
-
-    # Need this to handle first branch occurring in the file. Am assuming
-    # that first/second line in file always has the first branch but
-    # this might not always be true.
-    if examPat == '2008':
-        br_old = re.match(br_re, in_content[0].strip()).group(1)
-    elif examPat == '2012':
-        br_old = re.match(br_re, in_content[1].strip()).group(1)
-
-    # Build and write outputs for each branch appearing in the input file.
-    br_cur = br_old
-    br_content = []
+        pool.close()
+    finally:
+        pool.join()
+
+def hashBranch(in_content, examPat, clargs):
+    """
+    Returns a hash of the section of the input of a branch, along with
+    the options which change what's written for it.
+    """
+
+    br_hash = hashlib.sha1()
+    br_hash.update(repr((_MANIFEST_VERSION, examPat) + outputKey(clargs)))
     for line in in_content:
+        br_hash.update(line)
+        br_hash.update('\n')
+    return br_hash.hexdigest()
+
+def outputKey(clargs):
+    """
+    Returns a tuple of the options which change what's written for a
+    branch.
+    """
+
+    return (clargs.nowritesubj, clargs.nowriteprn, outExt(clargs),
+            getattr(clargs, 'formats', ['csv']), getattr(clargs, 'sqlite',
+                                                         None))
+
+def _checkUnchanged(old_man, keys_seen, br_name, in_content, examPat,
+        clargs, outDir):
+    """
+    Checks a branch against the manifest of the last run. Returns the
+    key and hash of the branch, and the name of its output file if the
+    branch is unchanged and the output is still there, else None. Does
+    nothing but return Nones when old_man is None.
+    """
+
+    if old_man is None:
+        return None, None, None
+
+    # The same branch may have more than one section in a file.
+    br_key = br_name
+    while br_key in keys_seen:
+        br_key = br_key + '+'
+    keys_seen.add(br_key)
+    br_hash = hashBranch(in_content, examPat, clargs)
+
+    entry = old_man.get(br_key)
+    if entry is None or entry.get('hash') != br_hash:
+        return br_key, br_hash, None
+    out_fname = str(entry.get('out_fname'))
+    for out_file in outPaths(outDir, out_fname, clargs):
+        if not os.path.isfile(out_file):
+            return br_key, br_hash, None
+    return br_key, br_hash, out_fname
+
+def loadManifest(man_fname):
+    """
+    Reads the manifest of an incremental run. A missing or unreadable
+    manifest is treated as empty; everything is rebuilt.
+    """
+
+    try:
+        man_file = open(man_fname, 'r')
+        try:
+            manifest = json.load(man_file)
+        finally:
+            man_file.close()
+    except (IOError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def saveManifest(man_fname, manifest):
+    """
+    Writes the manifest of an incremental run. It's written to a
+    temporary file first and renamed over the old one, so an interrupted
+    run leaves the old manifest in place. Raises OutputError if it
+    can't be written.
+    """
+
+    man_dir = os.path.dirname(man_fname) or '.'
+    try:
+        tmp_fd, tmp_name = tempfile.mkstemp(dir=man_dir, suffix='.tmp')
+        tmp_file = os.fdopen(tmp_fd, 'w')
+        try:
+            json.dump(manifest, tmp_file, indent=1, sort_keys=True)
+        finally:
+            tmp_file.close()
+        os.rename(tmp_name, man_fname)
+    except (IOError, OSError) as err:
+        raise OutputError('IO ERROR (%d): %s: %s' % (err.errno,
+                        err.strerror, man_fname))
+
+def sniffExPat(in_lines):
+    """
+    Finds the exam pattern reading no more of in_lines than needed.
+    Returns the exam pattern and an iterator over all of in_lines,
+    including the lines read to find the pattern.
+    """
+
+    head = []
+    def _keep():
+        for line in in_lines:
+            head.append(line)
+            yield line
+
+    examPat = exDt.scanContent(_keep(), fields=('exPat',))['exPat']
+    return examPat, itertools.chain(head, in_lines)
+
+def splitBranches(in_lines, br_re):
+    """
+    Splits the lines of the input by branch. Yields the branch name and
+    a list with the stripped lines of that branch, one branch at a time.
+    Arguments:
+            in_lines: Iterable over the lines of the input file.
+            br_re: Compiled regex matching the branch header lines.
+    """
+
+    # Lines ahead of the first branch header belong to the first branch.
+    br_cur = None
+    br_content = []
+    for line in in_lines:
         line = line.strip()
-        ret_obj = re.match(br_re, line)
+        ret_obj = br_re.match(line)
         if ret_obj:
-            br_old = br_cur
-            br_cur = ret_obj.group(1)
-            if br_cur != br_old:
-                print '\n', br_old
-                buildOut(br_content, outDir, examPat, clargs)
+            br_new = ret_obj.group(1)
+            if br_cur is not None and br_new != br_cur:
+                yield br_cur, br_content
                 br_content = []
+            br_cur = br_new
         br_content.append(line)
 
     # Need this to handle the final branch appearing in the file.
-    print '\n', br_old
-    buildOut(br_content, outDir, examPat, clargs)
-    
-    sys.exit(0)
+    if br_content:
+        yield br_cur, br_content
+
+def mapWindows(in_file, window=_MAP_WINDOW):
+    """
+    Memory maps in_file about window bytes at a time. Yields the map
+    along with the start and end in it of the whole lines not yielded
+    before. Each map is closed before the next is made, so no more than
+    a window of the file is resident at a time.
+    """
+
+    size = os.fstat(in_file.fileno()).st_size
+    start = 0
+    while start < size:
+        # Maps start at a multiple of the allocation granularity.
+        map_off = start - start % mmap.ALLOCATIONGRANULARITY
+        length = min(window + start - map_off, size - map_off)
+        while True:
+            in_map = mmap.mmap(in_file.fileno(), length,
+                            access=mmap.ACCESS_READ, offset=map_off)
+            if map_off + length == size:
+                end = length
+                break
+            end = in_map.rfind('\n', start - map_off) + 1
+            if end:
+                break
+            # A line longer than the window.
+            in_map.close()
+            length = min(2*length, size - map_off)
+        try:
+            yield in_map, start - map_off, end
+        finally:
+            in_map.close()
+        start = map_off + end
+
+def _markedLines(in_map, start, end, mark):
+    """
+    Yields the start, end and stripped text of each line between start
+    and end of in_map with mark in it. Lines end at '\n', '\r' or
+    '\r\n' as they do when read with universal newlines.
+    """
+
+    pos = in_map.find(mark, start, end)
+    while pos != -1:
+        line_start = in_map.rfind('\n', start, pos) + 1
+        line_start = max(line_start, start,
+                        in_map.rfind('\r', line_start, pos) + 1)
+        line_end = in_map.find('\n', pos, end)
+        if line_end == -1:
+            line_end = end
+        cr_pos = in_map.find('\r', pos, line_end)
+        if cr_pos != -1:
+            line_end = cr_pos
+        yield line_start, line_end, in_map[line_start:line_end].strip()
+        pos = in_map.find(mark, line_end, end)
+
+def _mapLines(in_map, start, end):
+    """
+    The stripped lines between start and end of in_map. They're split
+    out _MAP_BLOCK bytes at a time so no more than that is copied out
+    of the map at once.
+    """
+
+    lines = []
+    while start < end:
+        stop = in_map.rfind('\n', start, min(start + _MAP_BLOCK, end)) + 1
+        if stop <= start:
+            stop = end
+        lines.extend([line.strip() for line in
+                      in_map[start:stop].splitlines()])
+        start = stop
+    return lines
+
+def mapExPat(in_file):
+    """
+    Finds the exam pattern as sniffExPat does, from the mapped input.
+    Only lines with 'PUNE' in them can have the pattern, so only those
+    are looked at.
+    """
+
+    for in_map, start, end in mapWindows(in_file):
+        for line_start, line_end, line in _markedLines(in_map, start, end,
+                                                       'PUNE'):
+            if line.startswith('GRAND TOTAL'):
+                continue
+            # The first line with a pattern settles it, as in scanContent.
+            ret_obj = exDt._patCom_re.match(line)
+            if ret_obj:
+                examPat = ret_obj.group(1)
+                return examPat if examPat in ('2008', '2012') else 'UNKN'
+    return 'UNKN'
+
+def mapBranches(in_file, examPat, br_re, window=_MAP_WINDOW):
+    """
+    Splits the mapped input by branch. Yields the same as splitBranches.
+    Branch header lines are found by searching the map for the text
+    they all have, so only those lines are matched against br_re, and
+    the lines between them are split out a block at a time.
+    Arguments:
+            in_file: The input file, opened in binary mode.
+            examPat: Pattern of exam. 2008 or 2012.
+            br_re: Compiled regex matching the branch header lines.
+            window: Bytes of the input mapped at a time.
+    """
+
+    mark = _BR_MARKS[examPat]
+    br_cur = None
+    br_content = []
+    for in_map, start, end in mapWindows(in_file, window):
+        seg_start = start
+        for line_start, line_end, line in _markedLines(in_map, start, end,
+                                                       mark):
+            ret_obj = br_re.match(line)
+            if not ret_obj:
+                continue
+            br_new = ret_obj.group(1)
+            if br_cur is not None and br_new != br_cur:
+                br_content.extend(_mapLines(in_map, seg_start, line_start))
+                seg_start = line_start
+                yield br_cur, br_content
+                br_content = []
+            br_cur = br_new
+        br_content.extend(_mapLines(in_map, seg_start, end))
+
+    # Need this to handle the final branch appearing in the file.
+    if br_content:
+        yield br_cur, br_content
 
 def istext(in_filename):
     """
-    Establish that input file is a text file.
-    Source: http://stackoverflow.com/a/1446870/3262406
+    Establish that input file is a text file. Raises ReadError if it
+    can't be read.
     """
 
     try:
@@ -114,9 +975,15 @@ def istext(in_filename):
         finally:
             in_file.close()
     except IOError as ioe:
-        sys.stderr.write('IO ERROR (%d): %s: %s\n' %
-                        (ioe.errno, ioe.strerror, in_filename))
-        sys.exit(1)
+        raise ReadError('IO ERROR (%d): %s: %s' % (ioe.errno, ioe.strerror,
+                        in_filename))
+    return isTextBlock(s)
+
+def isTextBlock(s):
+    """
+    Whether the first 512 bytes of a file, s, look like text.
+    Source: http://stackoverflow.com/a/1446870/3262406
+    """
 
     text_characters = "".join(map(chr, range(32, 127)) + list("\n\r\t\b"))
     _null_trans = string.maketrans("", "")
@@ -133,9 +1000,70 @@ def istext(in_filename):
         return False
     return True
 
-def buildOut(in_content, outDir, examPat, clargs):
+def getCatalog(clargs):
+    """
+    Returns the subject catalog cache in clargs.cachedir or None if no
+    cache directory was asked for.
+    """
+
+    cacheDir = getattr(clargs, 'cachedir', None)
+    if not cacheDir:
+        return None
+    if cacheDir not in _catalogs:
+        _catalogs[cacheDir] = subjCatalog.SubjCatalog(cacheDir)
+    return _catalogs[cacheDir]
+
+def getDatabase(clargs):
+    """
+    Returns the connection to the SQLite database in clargs.sqlite,
+    opened once per process and thread; connections can't be shared
+    between threads.
+    """
+
+    key = (clargs.sqlite, thread.get_ident())
+    if key not in _databases:
+        _databases[key] = sqlSink.connect(clargs.sqlite)
+    return _databases[key]
+
+def writesFiles(clargs):
+    """
+    Whether output files are written to the output directory; not with
+    -c, nor when the records go to stdout.
+    """
+
+    return clargs.nowritecsv == False and not getattr(clargs, 'stdout',
+                                                      None)
+
+def planBranch(clargs, examPat):
+    """
+    Works out which fields of a branch the outputs asked for in clargs
+    need, so the rest aren't extracted. Returns a set which may hold
+    'subjects' and 'marks'. The header, PRNs and totals are always
+    extracted; the checks on a branch rest on them and they come from
+    the same pass over the content.
+    """
+
+    plan = set()
+    if examPat not in ('2008', '2012'):
+        return plan
+    writes = (writesFiles(clargs) or bool(getattr(clargs, 'sqlite', None))
+              or bool(getattr(clargs, 'stdout', None))
+              or getattr(clargs, 'keep', False))
+    # The details printed count the subject mark vectors.
+    if clargs.nowritesubj == False and (writes or
+                                        clargs.noprintdetail == False):
+        plan.update(('subjects', 'marks'))
+    if clargs.printsubj == True:
+        plan.add('subjects')
+    return plan
+
+def buildOut(in_content, outDir, examPat, clargs, prof=None, br_name=None,
+        writer=None, onheader=None):
     """
     Calls data get functions. Gets the data to write to the csv file.
+    Returns a BranchResult; its out_fname is the name of the output file
+    without extension, or None and its error set if the branch could not
+    be built. Raises OutputError if an output can't be written.
     Arguments:
             in_content: List with each line of input as one element of the
                     list.
@@ -143,40 +1071,56 @@ def buildOut(in_content, outDir, examPat, clargs):
             examPat: String naming the exam pattern.
             clargs: A argparse.Namespace object with the command line
                     arguments
+            prof: Optional instrument.Profile of the branch.
+            br_name: Name of the branch in the input.
+            writer: Optional BackgroundWriter the outputs are handed to
+                    instead of being written here. The result is only
+                    submitted to it when there's something to write.
+            onheader: Optional function called with the BranchResult
+                    once the header is sniffed, before the marks are
+                    extracted.
     """
 
-    br = exDt.Branch(examPat=examPat)
-    # Subject marks can only be extracted in the 2008 pat files.
-    br.subjects = exDt.getSubjects(in_content, br.examPat)
-    if (not br.subjects) and (br.examPat != '2012'):
-        sys.stderr.write('ERROR: Auto-detect subjects failed\n')
-        return
-    # Get PRN and total marks from file. PRN is most reliably extracted
-    # and forms basis for counts of students.
-    br.prn = exDt.getPRN(in_content)
+    if prof is None:
+        prof = instrument.NullProfile('buildOut')
+    prof.count('lines', len(in_content))
+    result = BranchResult(br_name, examPat, profile=prof)
+
+    # Header fields come from the first few lines of the branch, so they
+    # are there even for branches which fail later.
+    with prof.timed('header'):
+        header = exDt.sniffHeader(in_content, examPat)
+    result.header = header
+    if onheader is not None:
+        onheader(result)
+
+    # The rest of the fields the outputs need are extracted in a single
+    # pass over the content. Subject marks always padded to match length
+    # of PRN.
+    plan = planBranch(clargs, examPat)
+    br = exDt.parseBranch(in_content, examPat,
+                        getMarks=('marks' in plan),
+                        columnar=getattr(clargs, 'columnar', False),
+                        catalog=getCatalog(clargs), header=header,
+                        prof=prof, getSubjects=('subjects' in plan))
+    prof.count('students', len(br.prn))
+    prof.count('totals', len(br.totalMarks))
+    prof.count('subjects', len(br.subjDict or {}))
+    result.subjDict = br.subjDict
+    result.students = len(br.prn)
+    result.totals = len(br.totalMarks)
+    if 'subjects' in plan and not br.subjects:
+        result.error = 'Auto-detect subjects failed'
+        return result
+    # PRN is most reliably extracted and forms basis for counts of
+    # students.
     if not br.prn:
-        sys.stderr.write('ERROR: Extraction of PRN failed\n')
-        return
-    br.totalMarks = exDt.getTotal(in_content)
+        result.error = 'Extraction of PRN failed'
+        return result
     if not br.totalMarks:
-        sys.stderr.write('ERROR: Extraction of Total marks failed\n')
-        return
-    # Subject marks always padded to match length of PRN
-    if clargs.nowritesubj == False:
-        br.sMarkList = exDt.getSubjMark(in_content, br.subjects, len(br.prn),
-                                         br.examPat)
-
-    # Initialize branch attributes
-    br.brAbbr = exDt.getBranch(in_content, br.examPat)
-    br.colAbbr = exDt.getCollege(in_content)
-    br.year = exDt.getYear(in_content)
-    br.exDate = exDt.getExamDate(in_content, br.examPat)
-
-    # Print out details if they're available and asked for.
-    if clargs.printsubj == True and br.examPat == '2008':
-        pprint.pprint(exDt.getSubjDict(in_content, br.examPat))
-    if clargs.noprintdetail == False:
-        print br
+        result.error = 'Extraction of Total marks failed'
+        return result
+    result.details = str(br)
 
     out_fname = '-'.join([br.colAbbr, br.examPat, br.year, br.brAbbr,
                         br.exDate])
@@ -184,95 +1128,365 @@ def buildOut(in_content, outDir, examPat, clargs):
     # Crude check to ensure that scan through content is as expected.
     if len(br.prn) > len(br.totalMarks):
         # When lengths don't match pad total with 'nan'.
+        result.padded_rows = len(br.prn) - len(br.totalMarks)
+        result.misaligned = True
+        prof.count('padded_rows', result.padded_rows)
+        prof.count('misaligned_branches')
         while len(br.totalMarks) != len(br.prn):
             br.totalMarks.append((float('NaN'), float('NaN')))
-        sys.stderr.write('WARNING: Expect misalignment between PRN and'
-                        ' marks\n')
+        result.warnings.append('Expect misalignment between PRN and marks')
         # Indicate misalignment in filename
         out_fname = ''.join([out_fname, '-Misalign'])
     elif len(br.prn) < len(br.totalMarks):
-        sys.stderr.write('ERROR: Unexpected error while extracting data.'
-                        ' Total marks count more then number of students.\n')
-        return
+        result.error = ('Unexpected error while extracting data. Total'
+                        ' marks count more then number of students.')
+        return result
+    if getattr(clargs, 'columnar', False):
+        br.totalArr, br.graceArr = exDt.getTotalArrays(br.totalMarks)
+
+    result.out_fname = out_fname
+    if getattr(clargs, 'stdout', None):
+        with prof.timed('write'):
+            result.records = formatRecords(br, clargs, result.misaligned)
+    if getattr(clargs, 'keep', False):
+        with prof.timed('keep'):
+            result.branch = studentStore.compactBranch(br)
 
     #Write output to file.
-    writeOut(br, clargs, out_fname, outDir)
+    if writer is not None:
+        writer.submit(result, br, clargs, outDir)
+        return result
+    with prof.timed('write'):
+        result.outputs = writeOut(br, clargs, out_fname, outDir)
+    return result
 
 def writeOut(br, clargs, out_fname, outDir):
     """
-    Given the data to write out, this writes out the csv file.
+    Given the data to write out, this writes out the csv file. The
+    header and the layout of the rows are worked out once, and the rows
+    are formatted and written _WRITE_BATCH at a time. Returns the paths
+    of the files written. Raises OutputError if one can't be written.
     """
 
     # Generate csv heading tuple
     if clargs.nowriteprn == False:
-        head_tuple = ('PRN', 'College', 'Branch', 'TotalNoGrace', 'TotalGrace',
-                'SumTotal')
+        head_tuple = ['PRN', 'College', 'Branch', 'TotalNoGrace', 'TotalGrace',
+                'SumTotal']
     elif clargs.nowriteprn == True:
-        head_tuple = ('College', 'Branch', 'TotalNoGrace', 'TotalGrace',
-                'SumTotal')
-    for i in range(len(br.subjects)):
-        head_tuple = (head_tuple + (''.join([exDt.makeAbbr(br.subjects[i]),
-                                    '_PP']),))
-        head_tuple = (head_tuple + (''.join([exDt.makeAbbr(br.subjects[i]),
-                                    '_PR']),))
-        head_tuple = (head_tuple + (''.join([exDt.makeAbbr(br.subjects[i]),
-                                    '_OR']),))
-        head_tuple = (head_tuple + (''.join([exDt.makeAbbr(br.subjects[i]),
-                                    '_TW']),))
-
-    if clargs.nowritecsv == False:
-        try:
-            out_file = os.path.join(outDir, ''.join([out_fname, '.csv']))
-            csv_file = open(out_file, 'w')
+        head_tuple = ['College', 'Branch', 'TotalNoGrace', 'TotalGrace',
+                'SumTotal']
+    subj_abbrs, subj_cols = subjColumns(br, clargs)
+    head_tuple.extend(subj_cols)
+
+    written = []
+    formats = getattr(clargs, 'formats', ['csv'])
+    if writesFiles(clargs) and ('npz' in formats or 'parquet' in formats):
+        for fmt in ('npz', 'parquet'):
+            if fmt not in formats:
+                continue
+            out_file = colStore.outPath(outDir, out_fname, fmt)
+            writeFunc = colStore.writeNPZ if fmt == 'npz' else \
+                        colStore.writeParquet
             try:
-                csvwriter = csv.writer(csv_file)
-                csvwriter.writerow(head_tuple)
-                # Generate each row tuple
-                for prn_i in range(len(br.prn)):
-                    if clargs.nowriteprn == True:
-                        student_tuple = (br.colAbbr, br.brAbbr,
-                                br.totalMarks[prn_i][0],
-                                br.totalMarks[prn_i][1],
-                                br.totalMarks[prn_i][0] +
-                                br.totalMarks[prn_i][1])
-                    elif clargs.nowriteprn == False:
-                        student_tuple = (br.prn[prn_i], br.colAbbr, br.brAbbr,
-                                br.totalMarks[prn_i][0],
-                                br.totalMarks[prn_i][1],
-                                br.totalMarks[prn_i][0] +
-                                br.totalMarks[prn_i][1])
-                    if clargs.nowritesubj == False and br.examPat == '2008':
-                        student_tuple = (student_tuple +
-                                         tuple(br.sMarkList[prn_i]))
-                    csvwriter.writerow(student_tuple)
-                    student_tuple = ()
-            finally:
-                csv_file.close()
-                return
-        except IOError as ioe:
-            sys.stderr.write('IO ERROR (%d): %s: %s\n' %
-                            (ioe.errno, ioe.strerror, out_file))
-            sys.exit(1)
+                writeFunc(out_file, br, subj_cols,
+                        writePRN=(clargs.nowriteprn == False),
+                        compress=getattr(clargs, 'compress', None))
+            except (IOError, OSError) as ioe:
+                raise OutputError('IO ERROR (%d): %s: %s' % (ioe.errno,
+                                ioe.strerror, out_file))
+            written.append(out_file)
 
-def main():
+    if writesFiles(clargs) and 'csv' in formats:
+        if getattr(clargs, 'columnar', False):
+            rows = _columnarRows(br, clargs)
+        else:
+            rows = _studentRows(br, clargs)
+        out_file = os.path.join(outDir, out_fname + outExt(clargs))
+        try:
+            writeCSV(out_file, itertools.chain([[head_tuple]], rows),
+                    getattr(clargs, 'compress', None))
+        except (IOError, OSError) as ioe:
+            raise OutputError('IO ERROR (%d): %s: %s' % (ioe.errno,
+                            ioe.strerror, out_file))
+        written.append(out_file)
+
+    if getattr(clargs, 'sqlite', None):
+        try:
+            sqlSink.writeBranch(getDatabase(clargs), br, subj_abbrs,
+                    misaligned=out_fname.endswith('-Misalign'),
+                    writePRN=(clargs.nowriteprn == False))
+        except sqlite3.Error as sqle:
+            raise OutputError('SQLITE ERROR: %s: %s' % (sqle,
+                            clargs.sqlite))
+
+    return written
+
+def subjColumns(br, clargs):
     """
-    Parse command line arguments. And call functions which do
-    the real work.
+    Returns the abbreviations of the subjects of a Branch and the names
+    of their mark columns, as in the csv header. Both are empty with -s.
     """
-    #TODO: Add mutually exclusive command line argument groups.
 
-    parser = argparse.ArgumentParser()
+    subj_abbrs = []
+    subj_cols = []
+    abbr_counts = {}
+    for subj in (br.subjects if clargs.nowritesubj == False else []):
+        abbr = studentStore.abbrOf(subj)
+        # Different 2012 subjects may shorten to the same abbreviation;
+        # the later ones are numbered. 2008 headers are left as they
+        # always were.
+        abbr_counts[abbr] = abbr_counts.get(abbr, 0) + 1
+        if abbr_counts[abbr] > 1 and br.examPat == '2012':
+            abbr += str(abbr_counts[abbr])
+        subj_abbrs.append(abbr)
+        subj_cols.extend([abbr + '_' + head for head in
+                          exDt.HEADS[br.examPat]])
+    return subj_abbrs, subj_cols
 
-    parser.add_argument('in_filename',
-            help='Path to the input text file to read from.')
+def formatRecords(br, clargs, misaligned=False):
+    """
+    Formats the students of a Branch for stdout, as clargs.stdout asks.
+    'ndjson' gives a JSON object per student on a line of its own, with
+    the college, exam pattern, year, branch, exam date, PRN, totals and
+    the marks of each subject by head; missing marks are null. 'csv'
+    gives the rows of the csv file with the exam pattern, year and exam
+    date added, headed by a header row of the branch.
+    """
+
+    subj_abbrs, subj_cols = subjColumns(br, clargs)
+    buf = cStringIO.StringIO()
+    if clargs.stdout == 'csv':
+        lead = [br.colAbbr, br.examPat, br.year, br.brAbbr, br.exDate]
+        head_tuple = ['College', 'ExamPattern', 'Year', 'Branch', 'ExamDate',
+                      'TotalNoGrace', 'TotalGrace', 'SumTotal'] + subj_cols
+        if clargs.nowriteprn == False:
+            head_tuple.insert(0, 'PRN')
+        if getattr(clargs, 'columnar', False):
+            rows = _columnarRows(br, clargs, lead=lead)
+        else:
+            rows = _studentRows(br, clargs, lead=lead)
+        writer = csv.writer(buf)
+        writer.writerow(head_tuple)
+        for batch in rows:
+            writer.writerows(batch)
+        return buf.getvalue()
+
+    # The fields of the branch are the same for all of its students.
+    lead = ''.join('%s: %s, ' % (json.dumps(key), json.dumps(value)) for
+                key, value in [('college', br.colAbbr),
+                ('examPat', br.examPat), ('year', br.year),
+                ('branch', br.brAbbr), ('exDate', br.exDate),
+                ('misaligned', misaligned)])
+    heads = exDt.HEADS.get(br.examPat, ())
+    width = len(heads)
+    # 2008 subjects sharing an abbreviation keep it in the csv header,
+    # but the keys of marks must differ; the later ones are numbered.
+    keys = []
+    abbr_counts = {}
+    for abbr in subj_abbrs:
+        abbr_counts[abbr] = abbr_counts.get(abbr, 0) + 1
+        if abbr_counts[abbr] > 1:
+            abbr += str(abbr_counts[abbr])
+        keys.append(abbr)
+    for prn_i, (total, grace) in enumerate(br.totalMarks):
+        buf.write('{')
+        buf.write(lead)
+        if clargs.nowriteprn == False:
+            buf.write('"prn": %s, ' % json.dumps(br.prn[prn_i]))
+        buf.write('"total": %s, "grace": %s, "sumTotal": %s' % (
+                _jsonMark(total), _jsonMark(grace), _jsonMark(total + grace)))
+        if subj_abbrs:
+            marks = br.sMarkList[prn_i]
+            buf.write(', "marks": {%s}' % ', '.join('%s: {%s}' % (
+                    json.dumps(abbr), ', '.join('"%s": %s' % (head,
+                    _jsonMark(marks[width*s_idx + h_idx])) for h_idx, head
+                    in enumerate(heads))) for s_idx, abbr in
+                    enumerate(keys)))
+        buf.write('}\n')
+    return buf.getvalue()
+
+def _jsonMark(value):
+    """
+    A mark as JSON; null for 'nan'.
+    """
+
+    if value != value:
+        return 'null'
+    return str(int(value))
+
+def outPaths(outDir, out_fname, clargs):
+    """
+    Paths of all the output files of a branch, one per output format.
+    """
+
+    paths = []
+    for fmt in getattr(clargs, 'formats', ['csv']):
+        if fmt == 'csv':
+            paths.append(os.path.join(outDir, out_fname + outExt(clargs)))
+        else:
+            paths.append(colStore.outPath(outDir, out_fname, fmt))
+    return paths
+
+def outExt(clargs):
+    """
+    Extension of the output files, which depends on the compression.
+    """
+
+    return _OUT_EXTS[getattr(clargs, 'compress', None)]
+
+def writeCSV(out_file, batches, compress=None):
+    """
+    Writes lists of rows to a csv file. Each list is formatted into a
+    buffer in memory and written to the file in one go. The file is
+    written under a temporary name and renamed into place when done, so
+    readers never see a partly written file.
+    Arguments:
+            out_file: Path of the csv file.
+            batches: Iterable over lists of rows.
+            compress: None, 'gzip' or 'zstd'.
+    """
+
+    tmp_name = colStore.tmpName(out_file)
+    raw_file = open(tmp_name, 'wb' if compress else 'w', _WRITE_BUFFER)
+    try:
+        try:
+            if compress == 'gzip':
+                # No time stamp, and the name of the output rather than
+                # the temporary one; unchanged data gives an unchanged
+                # file.
+                sink = gzip.GzipFile(os.path.basename(out_file), 'wb',
+                                     fileobj=raw_file, mtime=0)
+            elif compress == 'zstd':
+                sink = zstd.ZstdCompressor().stream_writer(raw_file)
+            else:
+                sink = raw_file
+            for rows in batches:
+                buf = cStringIO.StringIO()
+                csv.writer(buf).writerows(rows)
+                sink.write(buf.getvalue())
+            if compress == 'gzip':
+                sink.close()
+            elif compress == 'zstd':
+                sink.flush(zstd.FLUSH_FRAME)
+        finally:
+            raw_file.close()
+        os.rename(tmp_name, out_file)
+    except:
+        colStore.removeQuietly(tmp_name)
+        raise
+
+def _studentRows(br, clargs, batch=_WRITE_BATCH, lead=None):
+    """
+    Yields the student rows of a Branch, batch rows at a time. lead are
+    the fields after the PRN; the college and branch by default.
+    """
+
+    if lead is None:
+        lead = [br.colAbbr, br.brAbbr]
+    write_prn = clargs.nowriteprn == False
+    write_subj = clargs.nowritesubj == False and bool(br.subjects)
+    for start in range(0, len(br.prn), batch):
+        rows = []
+        stop = start + batch
+        for prn_i, (total, grace) in enumerate(br.totalMarks[start:stop],
+                                              start):
+            row = [br.prn[prn_i]] + lead if write_prn else lead[:]
+            row.extend((total, grace, total + grace))
+            if write_subj:
+                row.extend(br.sMarkList[prn_i])
+            rows.append(row)
+        yield rows
+
+def _columnarRows(br, clargs, batch=_WRITE_BATCH, lead=None):
+    """
+    Yields the student rows of a Branch in the columnar representation,
+    formatted from the arrays batch rows at a time. lead is as for
+    _studentRows.
+    """
+
+    np = exDt.np
+    num_cols = [br.totalArr[:, None], br.graceArr[:, None],
+                (br.totalArr + br.graceArr)[:, None]]
+    if clargs.nowritesubj == False and br.subjects:
+        num_cols.append(br.sMarkList)
+    num_arr = np.hstack(num_cols)
+
+    if lead is None:
+        lead = [br.colAbbr, br.brAbbr]
+    for start in range(0, len(br.prn), batch):
+        num_rows = num_arr[start:start+batch]
+        # Marks are whole numbers or 'nan', written as the lists would.
+        num_rows = np.where(np.isnan(num_rows), 'nan',
+                            num_rows.astype(np.int64).astype(str)).tolist()
+        if clargs.nowriteprn == True:
+            yield [lead + row for row in num_rows]
+        else:
+            yield [[prn] + lead + row for prn, row in
+                    zip(br.prn[start:start+batch], num_rows)]
+
+def runCaptured(func, *args):
+    """
+    Calls func(*args) with stdout and stderr captured, for use in
+    worker processes whose output must be replayed in order. Exits are
+    caught. Returns a tuple with the return value, the exit status, the
+    captured stdout and the captured stderr.
+    """
+
+    old_out, old_err = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    ret, status = None, 0
+    try:
+        try:
+            ret = func(*args)
+        except SystemExit as sye:
+            if sye.code is None:
+                status = 0
+            elif isinstance(sye.code, int):
+                status = sye.code
+            else:
+                sys.stderr.write('%s\n' % sye.code)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        return ret, status, sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = old_out, old_err
+
+def _formats(arg):
+    """
+    Parses the comma separated list of output formats.
+    """
+
+    formats = [fmt.strip() for fmt in arg.split(',') if fmt.strip()]
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise argparse.ArgumentTypeError('unknown format: %s' % fmt)
+    if not formats:
+        raise argparse.ArgumentTypeError('no output format given')
+    return formats
+
+def addOutputArgs(parser):
+    """
+    Adds the arguments controlling the nature of output generated to an
+    argparse.ArgumentParser. Shared by all the command line entry
+    points.
+    """
 
     parser.add_argument('-d', '--noprintdetail',
             help="Don't print details of each csv file written to disk.",
             action='store_true', default=False)
 
+    parser.add_argument('-H', '--printheader',
+            help='Print college, year, branch and exam date of each'
+            ' branch before its marks are extracted, even those which'
+            ' fail to build. With -j or --bgwrite they are printed once'
+            ' the branch is built.',
+            action='store_true', default=False)
+
     parser.add_argument('-b', '--printsubj',
-            help='Print list of subjects for each branch. This is only '
-                    'supported for 2008 pattern files',
+            help='Print the subjects found in each branch, by subject'
+            ' code.',
             action='store_true', default=False)
 
     parser.add_argument('-c', '--nowritecsv',
@@ -282,14 +1496,102 @@ def main():
 
     parser.add_argument('-s', '--nowritesubj',
     help=" Don't write subject marks to csv file. Output will include only"
-            " the total marks. This is the default for anything except 2008"
-            " exam pattern files.", action='store_true', default=False)
+            " the total marks.", action='store_true', default=False)
 
     parser.add_argument('-p', '--nowriteprn',
             help="Don't write PRN to csv file. Use this to protect privacy of"
             " students.", action='store_true', default=False)
 
+    parser.add_argument('--columnar',
+            help="Hold marks in NumPy arrays rather than Python lists. Needs"
+            " NumPy. Output is the same.", action='store_true',
+            default=False)
+
+    parser.add_argument('--mmap',
+            help='Memory map the input and find the branches in it as'
+            ' bytes. Faster on large inputs. Output is the same.',
+            action='store_true', default=False)
+
+    parser.add_argument('-z', '--compress', choices=('gzip', 'zstd'),
+            help='Write csv files compressed with gzip (.csv.gz) or zstd'
+            ' (.csv.zst). zstd needs the zstandard package.')
+
+    parser.add_argument('-f', '--format', dest='formats', type=_formats,
+            default=['csv'], help='Comma separated output formats; any of'
+            ' csv, npz and parquet. npz and parquet files are typed and'
+            ' laid out in partitions by college, pattern, year, branch and'
+            ' exam date. npz needs NumPy and parquet pyarrow.')
+
+    parser.add_argument('-i', '--incremental',
+            help='Only rebuild the branches whose part of the input changed'
+            ' since the last incremental run. A manifest of the hashes is'
+            ' kept in the output directory.', action='store_true',
+            default=False)
+
+    parser.add_argument('--bgwrite',
+            help='Write the outputs of each branch on a background thread'
+            ' while the next branch is extracted. Helps most when the'
+            ' output directory is slow, as on network mounts. Not used'
+            ' with -j, whose workers write their own branches.',
+            action='store_true', default=False)
+
+    parser.add_argument('--outdir', default='outCSV',
+            help='Directory to write the outputs to. Defaults to outCSV.')
+
+    parser.add_argument('--profile', metavar='DIR',
+            help='Time the stages of the build and count what is seen in'
+            ' each branch. A JSON report for each input file is written to'
+            ' DIR.')
+
+    parser.add_argument('-T', '--timings',
+            help='Print the time spent in each stage after each branch.',
+            action='store_true', default=False)
+
+    parser.add_argument('--cprofile',
+            help='Also run cProfile over each input file and write the'
+            ' stats next to the report. Workers started by -j are not'
+            ' profiled.', action='store_true', default=False)
+
+    parser.add_argument('--cachedir',
+            help='Directory to cache the subjects of each branch in. Later'
+            ' runs, and other colleges of the branch, reuse the cached'
+            ' subjects instead of finding them again.')
+
+    parser.add_argument('--sqlite', metavar='DB',
+            help='SQLite database to load the branches into as well. A'
+            ' branch loaded again replaces its earlier rows. Use with -c'
+            ' to load the database only.')
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+    #TODO: Add mutually exclusive command line argument groups.
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('in_filename',
+            help="Path to the input text file to read from. '-' reads it"
+            " from stdin.")
+
+    parser.add_argument('-j', '--jobs', dest='brjobs', type=int, default=1,
+            help='Number of worker processes to build the branches of the'
+            ' input file with. Output is still printed in file order.')
+
+    parser.add_argument('--stdout', choices=('ndjson', 'csv'),
+            help='Write the students to stdout as each branch is built,'
+            ' a JSON object per line or csv rows, instead of writing'
+            ' output files. The details are printed to stderr.')
+
+    addOutputArgs(parser)
+
     clargs = parser.parse_args()
+    if clargs.brjobs < 1:
+        parser.error('--jobs must be at least 1')
+    if clargs.stdout:
+        # Stop quietly, like other filters, when the reader goes away.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     branchBuild(clargs)
 
 if __name__ == '__main__':
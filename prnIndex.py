@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+An index of where the marks of each student are in the input text
+files, for looking up a few students without converting whole files.
+The block of a student runs from their student header line, the one
+with the PRN, to the GRAND TOTAL line. The file, byte offset and length
+of each block, and of the page header above it, are kept in a SQLite
+database. A lookup memory maps the file and parses only those bytes
+with extractData.
+"""
+
+import os
+import sys
+import mmap
+import sqlite3
+import argparse
+import extractData as exDt
+import batchBldOut
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    prn TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    hdr_offset INTEGER NOT NULL,
+    hdr_length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_prn ON blocks (prn);
+CREATE INDEX IF NOT EXISTS blocks_file ON blocks (file_id);
+'''
+
+
+def connect(db_path):
+    """
+    Opens the index at db_path, creating the tables if they aren't
+    there.
+    """
+
+    conn = sqlite3.connect(db_path)
+    conn.text_factory = str
+    conn.executescript(_SCHEMA)
+    conn.commit()
+    return conn
+
+def scanBlocks(in_file):
+    """
+    Yields (PRN, offset, length, header offset, header length) for the
+    block of each student in an input file opened in binary mode. Lines
+    are told apart the way extractData.scanContent does. A block cut
+    short by the next student header line or the end of the file ends
+    there.
+    """
+
+    offset = 0
+    hdr_start = hdr_end = 0
+    in_hdr = False
+    block = None
+    for line in in_file:
+        start = offset
+        offset += len(line)
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('GRAND TOTAL'):
+            if block is not None:
+                prn, br_start, hdr = block
+                yield (prn, br_start, offset - br_start) + hdr
+                block = None
+            continue
+
+        # Page header lines; the first of a run starts a new page header.
+        if exDt.isPageHeader(line):
+            if not in_hdr:
+                hdr_start = start
+                in_hdr = True
+            hdr_end = offset
+            continue
+
+        ret_obj = exDt._PRNCom_re.search(line)
+        if ret_obj:
+            if block is not None:
+                prn, br_start, hdr = block
+                yield (prn, br_start, start - br_start) + hdr
+            in_hdr = False
+            block = (ret_obj.group(1), start,
+                     (hdr_start, hdr_end - hdr_start))
+
+    if block is not None:
+        prn, br_start, hdr = block
+        yield (prn, br_start, offset - br_start) + hdr
+
+def indexFiles(conn, in_files, quiet=False):
+    """
+    Indexes the student blocks of the input files, one transaction per
+    file. Files indexed before are indexed again only if their size or
+    modification time changed. Returns the number of files indexed.
+    """
+
+    indexed = 0
+    for in_filename in in_files:
+        path = os.path.abspath(in_filename)
+        try:
+            stat = os.stat(path)
+            in_file = open(path, 'rb')
+        except (IOError, OSError) as ioe:
+            sys.stderr.write('IO ERROR (%d): %s: %s\n' %
+                            (ioe.errno, ioe.strerror, in_filename))
+            continue
+
+        try:
+            row = conn.execute('SELECT id, size, mtime FROM files WHERE'
+                               ' path = ?', (path,)).fetchone()
+            if row is not None and (row[1], row[2]) == (stat.st_size,
+                                                        stat.st_mtime):
+                if not quiet:
+                    print 'Unchanged since last run: %s' % in_filename
+                continue
+
+            with conn:
+                if row is None:
+                    file_id = conn.execute('INSERT INTO files (path, size,'
+                                ' mtime) VALUES (?, ?, ?)', (path,
+                                stat.st_size, stat.st_mtime)).lastrowid
+                else:
+                    file_id = row[0]
+                    conn.execute('UPDATE files SET size = ?, mtime = ?'
+                                 ' WHERE id = ?', (stat.st_size,
+                                 stat.st_mtime, file_id))
+                    conn.execute('DELETE FROM blocks WHERE file_id = ?',
+                                 (file_id,))
+                cur = conn.executemany('INSERT INTO blocks VALUES (?, ?, ?,'
+                                ' ?, ?, ?)', ((file_id,) + block for block
+                                in scanBlocks(in_file)))
+            indexed += 1
+            if not quiet:
+                print 'Indexed %d students: %s' % (cur.rowcount,
+                                                    in_filename)
+        finally:
+            in_file.close()
+
+    return indexed
+
+def findBlocks(conn, prns):
+    """
+    Yields (path, offset, header text, block text) for the blocks of
+    the students with the given PRNs, in file order. The files are
+    memory mapped once each. Files changed since they were indexed are
+    skipped with a warning.
+    """
+
+    if not prns:
+        return
+    rows = conn.execute('SELECT f.path, f.size, f.mtime, b.offset, b.length,'
+                        ' b.hdr_offset, b.hdr_length FROM blocks b JOIN'
+                        ' files f ON b.file_id = f.id WHERE b.prn IN (%s)'
+                        ' ORDER BY f.path, b.offset' %
+                        ', '.join('?'*len(prns)), list(prns))
+
+    maps = {}
+    try:
+        for path, size, mtime, offset, length, hdr_off, hdr_len in rows:
+            if path not in maps:
+                maps[path] = _mapFile(path, size, mtime)
+            in_map = maps[path]
+            if in_map is None:
+                continue
+            yield (path, offset, in_map[hdr_off:hdr_off+hdr_len],
+                   in_map[offset:offset+length])
+    finally:
+        for in_map in maps.values():
+            if in_map is not None:
+                in_map.close()
+
+def _mapFile(path, size, mtime):
+    """
+    Memory maps a file for reading. Returns None, after a warning, if
+    the file is gone or has changed since it was indexed.
+    """
+
+    try:
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime) != (size, mtime):
+            sys.stderr.write('WARNING: Changed since indexed, index it'
+                            ' again: %s\n' % path)
+            return None
+        in_file = open(path, 'rb')
+    except (IOError, OSError) as ioe:
+        sys.stderr.write('IO ERROR (%d): %s: %s\n' % (ioe.errno,
+                        ioe.strerror, path))
+        return None
+    try:
+        return mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        in_file.close()
+
+def parseBlock(hdr_text, block_text):
+    """
+    Parses the block of one student, with the page header above it,
+    into a Branch of that one student.
+    """
+
+    in_content = (hdr_text + block_text).splitlines()
+    examPat = exDt.sniffHeader(in_content, fields=('exPat',))['exPat']
+    return exDt.parseBranch(in_content, examPat)
+
+def printStudent(path, offset, br):
+    """
+    Prints the totals and subject marks of the one student in br.
+    """
+
+    print '%s @ %d' % (path, offset)
+    print 'PRN: %s' % (br.prn[0] if br.prn else 'UNKN')
+    print 'College: %s, Pattern: %s, Year: %s, Branch: %s, Exam date: %s' % (
+            br.colAbbr, br.examPat, br.year, br.brAbbr, br.exDate)
+    if br.totalMarks:
+        print 'Total: %s, Grace: %s' % br.totalMarks[0]
+    if br.sMarkList:
+        marks = br.sMarkList[0]
+        heads = exDt.HEADS[br.examPat]
+        for s_idx, subj in enumerate(br.subjects):
+            print '%-12s %s' % (exDt.makeAbbr(subj), '  '.join('%s %s' % (
+                    head, marks[len(heads)*s_idx + h_idx]) for h_idx, head
+                    in enumerate(heads)))
+    print
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='prnIndex.db',
+            help='The index database. Defaults to prnIndex.db.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    index_parser = subparsers.add_parser('index',
+            help='Index the student blocks of input text files.')
+    index_parser.add_argument('in_paths', nargs='+',
+            help='Input text files, directories holding them or globs.')
+    index_parser.add_argument('-q', '--quiet',
+            help="Don't print a line per file.", action='store_true',
+            default=False)
+
+    lookup_parser = subparsers.add_parser('lookup',
+            help='Print the marks of students from the indexed files.')
+    lookup_parser.add_argument('prns', nargs='+', metavar='PRN',
+            help='Permanent registration numbers to look up.')
+    lookup_parser.add_argument('-r', '--raw',
+            help='Print the text of the blocks instead of parsing them.',
+            action='store_true', default=False)
+
+    clargs = parser.parse_args()
+
+    try:
+        conn = connect(clargs.db)
+    except sqlite3.Error as sqle:
+        sys.stderr.write('SQLITE ERROR: %s: %s\n' % (sqle, clargs.db))
+        sys.exit(1)
+
+    if clargs.command == 'index':
+        in_files = batchBldOut.expandInputs(clargs.in_paths)
+        indexFiles(conn, in_files, clargs.quiet)
+        sys.exit(0)
+
+    found = 0
+    for path, offset, hdr_text, block_text in findBlocks(conn,
+                                                         clargs.prns):
+        found += 1
+        if clargs.raw:
+            print '%s @ %d' % (path, offset)
+            sys.stdout.write(block_text)
+            print
+        else:
+            printStudent(path, offset, parseBlock(hdr_text, block_text))
+    if not found:
+        sys.stderr.write('ERROR: No student with PRN %s in the index\n' %
+                        ', '.join(clargs.prns))
+        sys.exit(1)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Writes branches straight into a SQLite database. The tables are
+normalized; a row per branch, per student, per subject of a branch and
+per head of passing of a subject a student has marks for. Each branch
+goes in one transaction. Loading a branch again replaces what was
+loaded for it before, so reruns don't duplicate rows.
+"""
+
+import re
+import sqlite3
+import extractData as exDt
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS branches (
+    id INTEGER PRIMARY KEY,
+    college TEXT NOT NULL,
+    examPat TEXT NOT NULL,
+    year TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    exDate TEXT NOT NULL,
+    misaligned INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (college, examPat, year, branch, exDate)
+);
+CREATE TABLE IF NOT EXISTS students (
+    branch_id INTEGER NOT NULL REFERENCES branches (id),
+    row INTEGER NOT NULL,
+    prn TEXT NOT NULL,
+    total INTEGER,
+    grace INTEGER,
+    PRIMARY KEY (branch_id, row)
+);
+CREATE TABLE IF NOT EXISTS subjects (
+    branch_id INTEGER NOT NULL REFERENCES branches (id),
+    idx INTEGER NOT NULL,
+    abbr TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (branch_id, idx)
+);
+CREATE TABLE IF NOT EXISTS marks (
+    branch_id INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    subject INTEGER NOT NULL,
+    head TEXT NOT NULL,
+    mark INTEGER,
+    PRIMARY KEY (branch_id, row, subject, head)
+);
+CREATE INDEX IF NOT EXISTS students_prn ON students (prn);
+CREATE INDEX IF NOT EXISTS branches_college_branch ON branches (college,
+    branch);
+CREATE INDEX IF NOT EXISTS branches_exDate ON branches (exDate);
+CREATE VIEW IF NOT EXISTS results AS
+    SELECT b.college, b.examPat, b.year, b.branch, b.exDate, s.prn,
+        s.total, s.grace, s.total + s.grace AS sumTotal
+    FROM students s JOIN branches b ON s.branch_id = b.id;
+'''
+
+# Seconds to wait for other processes loading into the same database.
+_BUSY_TIMEOUT = 300
+
+
+def connect(db_path):
+    """
+    Opens the database at db_path, creating the tables and indexes if
+    they aren't there.
+    """
+
+    conn = sqlite3.connect(db_path, timeout=_BUSY_TIMEOUT)
+    conn.text_factory = str
+    conn.executescript(_SCHEMA)
+    conn.commit()
+    return conn
+
+def _num(value):
+    """
+    Marks as integers, with NaN, the marks that couldn't be read, as
+    NULL.
+    """
+
+    return None if value != value else int(value)
+
+def writeBranch(conn, br, subjAbbrs, misaligned=False, writePRN=True):
+    """
+    Loads a Branch into the database in one transaction, replacing the
+    rows of an earlier load of the same branch.
+    Arguments:
+            conn: Connection returned by connect.
+            br: The Branch.
+            subjAbbrs: Abbreviations of br.subjects, as in the csv
+                    header.
+            misaligned: Whether PRNs and marks may be misaligned.
+            writePRN: Whether PRNs are written. Students are numbered
+                    in place of their PRN when False.
+    """
+
+    key = (br.colAbbr, br.examPat, br.year, br.brAbbr, br.exDate)
+    with conn:
+        cur = conn.cursor()
+        cur.execute('INSERT OR IGNORE INTO branches (college, examPat, year,'
+                    ' branch, exDate) VALUES (?, ?, ?, ?, ?)', key)
+        cur.execute('SELECT id FROM branches WHERE college = ? AND'
+                    ' examPat = ? AND year = ? AND branch = ? AND'
+                    ' exDate = ?', key)
+        br_id = cur.fetchone()[0]
+        cur.execute('UPDATE branches SET misaligned = ? WHERE id = ?',
+                    (int(bool(misaligned)), br_id))
+        for table in ('marks', 'subjects', 'students'):
+            cur.execute('DELETE FROM %s WHERE branch_id = ?' % table,
+                        (br_id,))
+
+        cur.executemany('INSERT INTO subjects VALUES (?, ?, ?, ?)',
+                        [(br_id, s_idx, abbr, _subjName(subj)) for s_idx,
+                        (subj, abbr) in enumerate(zip(br.subjects,
+                                                      subjAbbrs))])
+
+        cur.executemany('INSERT INTO students VALUES (?, ?, ?, ?, ?)',
+                        ((br_id, row, prn if writePRN else str(row),
+                          _num(tmark[0]), _num(tmark[1])) for row,
+                         (prn, tmark) in enumerate(zip(br.prn,
+                                                       br.totalMarks))))
+
+        if br.sMarkList is not None and subjAbbrs:
+            cur.executemany('INSERT INTO marks VALUES (?, ?, ?, ?, ?)',
+                            _markRows(br_id, br.sMarkList, len(subjAbbrs),
+                                      exDt.HEADS[br.examPat]))
+
+def _markRows(br_id, sMarkList, subjCount, heads):
+    """
+    Yields the rows of the marks table of a branch, one for each subject
+    mark column of the csv file. heads are the columns of each subject.
+    """
+
+    width = len(heads)
+    for row, marks in enumerate(sMarkList):
+        marks = list(marks)
+        for s_idx in range(subjCount):
+            for h_idx, head in enumerate(heads):
+                yield (br_id, row, s_idx, head,
+                       _num(marks[width*s_idx + h_idx]))
+
+def _subjName(subj):
+    """
+    The subject names in a subject regex of getSubjects, with electives
+    of a slot separated by '|'.
+    """
+
+    return re.sub(r'\\(.)', r'\1', subj[1:-1])
@@ -0,0 +1,297 @@
+"""
+A compact form of the students of a Branch, for holding the results of
+many files in memory at once. The marks of a branch are kept in typed
+arrays, one cell per mark with a sentinel for 'nan', rather than as
+lists of Python numbers, and the PRNs in a single string. Marks take a
+byte each when all of a branch's fit in one, two otherwise.
+College, branch, year, exam date and subject names are interned in one
+table shared by all branches, so each name is kept only once.
+
+A CompactBranch has the attributes of an extractData.Branch, so it can
+be written out like one:
+
+    cbr = studentStore.compactBranch(br)
+    for student in cbr.students():
+        print student.prn, student.total, student.marks
+"""
+
+import array
+
+import extractData as exDt
+
+# NumPy is only needed to turn the marks back into a matrix.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Marks and totals are stored as signed 8 or 16 bit integers, array type
+# codes 'b' and 'h'; the smallest value of each stands for a missing
+# mark.
+_MISSING = {'b': -128, 'h': -32768}
+_NAN = float('NaN')
+
+# The intern table; each name maps to the one copy of it kept.
+_names = {}
+# Abbreviations of the names passed to abbrOf.
+_abbrs = {}
+
+
+def internName(name):
+    """
+    Returns the one copy of name kept in the intern table, adding it if
+    it isn't there yet.
+    """
+
+    return _names.setdefault(name, name)
+
+def abbrOf(name):
+    """
+    extractData.makeAbbr of a subject or branch name, interned. Each
+    name is abbreviated only once.
+    """
+
+    abbr = _abbrs.get(name)
+    if abbr is None:
+        abbr = _abbrs[name] = internName(exDt.makeAbbr(name))
+    return abbr
+
+def internedNames():
+    """
+    Number of names in the intern table.
+    """
+
+    return len(_names)
+
+def _pack(value, missing=_MISSING['h']):
+    """
+    A mark as stored; missing for 'nan'.
+    """
+
+    if value != value:
+        return missing
+    return int(value)
+
+def _unpack(cell, missing=_MISSING['h']):
+    """
+    A stored mark as a Branch holds it; 'nan' for missing.
+    """
+
+    if cell == missing:
+        return _NAN
+    return cell
+
+def _packArray(values):
+    """
+    Stores a list of marks, as packed for 'h', in the smallest array
+    they fit in.
+    """
+
+    present = [value for value in values if value != _MISSING['h']]
+    if present and not -128 < min(present) <= max(present) < 128:
+        return array.array('h', values)
+    return array.array('b', [_MISSING['b'] if value == _MISSING['h'] else
+                             value for value in values])
+
+
+class Student(object):
+    """
+    The record of one student of a CompactBranch.
+
+    Attributes: prn, total, grace, marks. total and grace are 'nan' when
+    missing. marks is a list of the marks of each subject in the order
+    of extractData.HEADS of the exam pattern, with 'nan' for missing
+    marks.
+    """
+
+    __slots__ = ('prn', 'total', 'grace', 'marks')
+
+    def __init__(self, prn, total, grace, marks):
+        self.prn = prn
+        self.total = total
+        self.grace = grace
+        self.marks = marks
+
+    def __repr__(self):
+        return '<Student %s: %s + %s>' % (self.prn, self.total, self.grace)
+
+
+class _Column(object):
+    """
+    A read only sequence over the rows of a CompactBranch; row(idx)
+    makes the item at idx.
+    """
+
+    __slots__ = ('_length', '_row')
+
+    def __init__(self, length, row):
+        self._length = length
+        self._row = row
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._row(row_i) for row_i in
+                    xrange(*idx.indices(self._length))]
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError('row index out of range')
+        return self._row(idx)
+
+    def __iter__(self):
+        for row_i in xrange(self._length):
+            yield self._row(row_i)
+
+
+def _rowMarks(cells, width, row_i):
+    """
+    The marks of row row_i of cells, width marks a row.
+    """
+
+    missing = _MISSING[cells.typecode]
+    start = row_i * width
+    return [_unpack(cell, missing) for cell in cells[start:start+width]]
+
+
+class _MarkRows(_Column):
+    """
+    The marks of a CompactBranch as sMarkList; a list of marks per
+    student. Also turns into a NumPy matrix with 'nan' for missing
+    marks.
+    """
+
+    __slots__ = ('_cells', '_width')
+
+    def __init__(self, cells, width, length):
+        _Column.__init__(self, length, self._marks)
+        self._cells = cells
+        self._width = width
+
+    def _marks(self, row_i):
+        return _rowMarks(self._cells, self._width, row_i)
+
+    def __array__(self, dtype=None):
+        assert np is not None, 'NumPy is needed to make an array'
+        np_type = np.int8 if self._cells.typecode == 'b' else np.int16
+        arr = np.frombuffer(self._cells, dtype=np_type).astype(np.float32)
+        arr[arr == _MISSING[self._cells.typecode]] = np.nan
+        arr = arr.reshape(self._length, self._width)
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+
+class CompactBranch(object):
+    """
+    Holds the students of a branch compactly; see compactBranch. Has the
+    attributes of an extractData.Branch, but prn, totalMarks and
+    sMarkList are read only sequences made from the arrays as they are
+    read, and totalArr and graceArr are always None.
+
+    Attributes: brAbbr, colAbbr, year, exDate, examPat, subjects,
+            subjDict, prn, totalMarks, sMarkList
+    """
+
+    __slots__ = ('brAbbr', 'colAbbr', 'year', 'exDate', 'examPat',
+                 'subjects', 'subjDict', '_count', '_prns', '_prnWidth',
+                 '_totals', '_graces', '_cells', '_width', '_markRows')
+
+    totalArr = None
+    graceArr = None
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def prn(self):
+        return _Column(self._count, self._prnAt)
+
+    @property
+    def totalMarks(self):
+        return _Column(self._count, self._totalAt)
+
+    @property
+    def sMarkList(self):
+        if self._markRows is None:
+            return None
+        return _MarkRows(self._cells, self._width, self._markRows)
+
+    def _prnAt(self, row_i):
+        start = row_i * self._prnWidth
+        return self._prns[start:start+self._prnWidth].rstrip()
+
+    def _totalAt(self, row_i):
+        return (_unpack(self._totals[row_i]), _unpack(self._graces[row_i]))
+
+    def student(self, row_i):
+        """
+        The Student record of the student at row row_i.
+        """
+
+        total, grace = self._totalAt(row_i)
+        marks = None
+        if self._markRows:
+            marks = _rowMarks(self._cells, self._width, row_i)
+        return Student(self._prnAt(row_i), total, grace, marks)
+
+    def students(self):
+        """
+        Yields the Student record of each student in turn.
+        """
+
+        for row_i in xrange(self._count):
+            yield self.student(row_i)
+
+    # Printed as a Branch is.
+    __str__ = exDt.Branch.__dict__['__str__']
+
+
+def compactBranch(br):
+    """
+    Returns a CompactBranch with the students of a Branch; in either
+    representation of marks. The totals of br must have been padded to
+    the number of PRNs. Marks and totals must fit in 16 bits.
+    """
+
+    count = len(br.prn)
+    assert len(br.totalMarks) == count, 'totals not padded to PRN count'
+
+    cbr = CompactBranch()
+    for attr in ('brAbbr', 'colAbbr', 'year', 'exDate', 'examPat'):
+        setattr(cbr, attr, internName(getattr(br, attr)))
+    cbr.subjects = [internName(subj) for subj in br.subjects or []]
+    cbr.subjDict = None
+    if br.subjDict is not None:
+        cbr.subjDict = dict((internName(code), internName(name)) for
+                            code, name in br.subjDict.items())
+
+    # PRNs are padded to the same width so the one string can be
+    # indexed by row.
+    cbr._count = count
+    cbr._prnWidth = max([len(prn) for prn in br.prn] or [0])
+    cbr._prns = ''.join([prn.ljust(cbr._prnWidth) for prn in br.prn])
+    cbr._totals = array.array('h', [_pack(tmark[0]) for tmark in
+                                    br.totalMarks])
+    cbr._graces = array.array('h', [_pack(tmark[1]) for tmark in
+                                    br.totalMarks])
+
+    cbr._markRows = None
+    cbr._width = 0
+    cbr._cells = array.array('b')
+    if br.sMarkList is not None:
+        cbr._markRows = len(br.sMarkList)
+        if cbr._markRows:
+            cbr._width = len(br.sMarkList[0])
+        if np is not None and isinstance(br.sMarkList, np.ndarray):
+            # The columnar matrix converts in one go.
+            cells = np.where(np.isnan(br.sMarkList), _MISSING['h'],
+                             br.sMarkList).astype(int).ravel().tolist()
+        else:
+            cells = [_pack(mark) for marks in br.sMarkList for mark in
+                     marks]
+        cbr._cells = _packArray(cells)
+    return cbr
@@ -0,0 +1,80 @@
+"""
+A cache of the subject catalogs of branches kept on disk. The subjects
+of a branch in an exam pattern and year are the same across colleges so
+a catalog found once is reused instead of being discovered again from
+the mark lines of every college.
+"""
+
+import os
+import re
+import json
+import tempfile
+import colStore
+
+
+class SubjCatalog(object):
+    """
+    Subject catalogs keyed on (examPat, year, brAbbr). Each catalog is
+    kept as a list of (code, subject) pairs in a JSON file of its own in
+    cacheDir. Catalogs read once are kept in memory too.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.catalogs = {}
+
+    def _fname(self, key):
+        """
+        Returns the path of the file holding the catalog for key.
+        """
+
+        name = '-'.join(re.sub(r'[^A-Za-z0-9]+', '_', str(k)) for k in key)
+        return os.path.join(self.cacheDir, name + '.json')
+
+    def get(self, key):
+        """
+        Returns the list of (code, subject) pairs for key or None if
+        there's no catalog for key.
+        """
+
+        if key in self.catalogs:
+            return self.catalogs[key]
+
+        try:
+            cat_file = open(self._fname(key), 'r')
+            try:
+                pairs = json.load(cat_file)
+            finally:
+                cat_file.close()
+        except (IOError, ValueError):
+            return None
+
+        # json gives back unicode, the rest of the code works with str.
+        pairs = [(str(code), str(s_name)) for code, s_name in pairs]
+        self.catalogs[key] = pairs
+        return pairs
+
+    def put(self, key, pairs):
+        """
+        Stores the list of (code, subject) pairs for key. The file is
+        written to a temporary file first and renamed over the old one
+        so concurrent readers never see half a catalog. A catalog which
+        can't be written is only kept in memory.
+        """
+
+        self.catalogs[key] = list(pairs)
+        try:
+            colStore.makeDirs(self.cacheDir)
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=self.cacheDir,
+                                                suffix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            tmp_file = os.fdopen(tmp_fd, 'w')
+            try:
+                json.dump(self.catalogs[key], tmp_file)
+            finally:
+                tmp_file.close()
+            os.rename(tmp_name, self._fname(key))
+        except (IOError, OSError):
+            colStore.removeQuietly(tmp_name)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Watches an inbox directory and builds the outputs of input text files
+as they arrive. The files are built on a pool of worker processes
+started once for the life of the daemon, so a new file doesn't wait
+for interpreters to start and modules to load. Once built each input
+is moved to a done or a failed directory; a bad file is reported and
+the daemon carries on.
+"""
+
+import os
+import sys
+import glob
+import time
+import signal
+import argparse
+import multiprocessing
+import batchBldOut
+import colStore
+import prepInBldOut as pIBO
+
+
+# Seconds between looks at the inbox.
+_POLL_INTERVAL = 0.2
+
+
+def pollInbox(inbox, stamps):
+    """
+    Returns the input files in inbox which are ready to be built; those
+    whose size and modification time are unchanged since the last poll,
+    so files still being written are left for a later poll.
+    Arguments:
+            inbox: The directory watched. Its '*.txt' files are inputs.
+            stamps: Dict of the (size, mtime) of each input at the last
+                    poll. Updated for this poll.
+    """
+
+    ready = []
+    current = {}
+    for in_filename in sorted(glob.glob(os.path.join(inbox, '*.txt'))):
+        try:
+            stat = os.stat(in_filename)
+        except OSError:
+            # Moved away meanwhile.
+            continue
+        stamp = (stat.st_size, stat.st_mtime)
+        current[in_filename] = stamp
+        if stamps.get(in_filename) == stamp:
+            ready.append(in_filename)
+    stamps.clear()
+    stamps.update(current)
+    return ready
+
+def moveInput(in_filename, dest_dir):
+    """
+    Moves a built input file into dest_dir, replacing any file of the
+    same name there. Returns the new path, or None if it couldn't be
+    moved.
+    """
+
+    dest = os.path.join(dest_dir, os.path.basename(in_filename))
+    try:
+        colStore.makeDirs(dest_dir)
+        os.rename(in_filename, dest)
+    except OSError as ose:
+        sys.stderr.write('OS ERROR (%d): %s: %s\n' % (ose.errno,
+                        ose.strerror, in_filename))
+        return None
+    return dest
+
+def finishFile(in_filename, started, async_res, clargs):
+    """
+    Reports how the build of an input file fared and moves the file to
+    the done or the failed directory. Returns whether it was moved.
+    """
+
+    try:
+        res = async_res.get()
+    except Exception as exc:
+        # The worker itself failed; convFile catches everything else.
+        res = {'in_filename': in_filename, 'state': 'failed', 'exit': 1,
+               'branches': 0, 'failed': [], 'misaligned': [],
+               'stdout': '', 'stderr': 'ERROR: %s\n' % exc}
+
+    if not clargs.quiet:
+        sys.stdout.write(res['stdout'])
+        sys.stderr.write(res['stderr'])
+    dest_dir = clargs.failed if res['state'] == 'failed' else clargs.done
+    moved = moveInput(in_filename, dest_dir) is not None
+    print '%-10s %s (branches: %d, failed: %d, misaligned: %d, %.2f s)' % (
+            res['state'].upper(), in_filename, res['branches'],
+            len(res['failed']), len(res['misaligned']),
+            time.time() - started)
+    sys.stdout.flush()
+    return moved
+
+def _ignoreInterrupt():
+    """
+    Makes workers ignore Ctrl-C; the daemon stops them itself.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watch(clargs):
+    """
+    Builds the inputs arriving in clargs.inbox till interrupted or
+    terminated.
+    Arguments:
+            clargs: A argparse.Namespace object with the command line
+                    arguments
+    """
+
+    pool = multiprocessing.Pool(clargs.jobs, _ignoreInterrupt)
+    # Stop between polls rather than wherever the signal lands, which
+    # may be inside the pool with its locks held.
+    stopping = []
+    def _stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    stamps = {}
+    pending = {}
+    # Inputs which couldn't be moved out of the inbox; not built again.
+    stuck = set()
+    try:
+        print 'Watching %s' % clargs.inbox
+        sys.stdout.flush()
+        while not stopping:
+            for in_filename in pollInbox(clargs.inbox, stamps):
+                if in_filename not in pending and in_filename not in stuck:
+                    pending[in_filename] = (time.time(), pool.apply_async(
+                                batchBldOut.convFile, (in_filename, clargs)))
+            for in_filename in sorted(pending):
+                started, async_res = pending[in_filename]
+                if async_res.ready():
+                    del pending[in_filename]
+                    if not finishFile(in_filename, started, async_res,
+                                      clargs):
+                        stuck.add(in_filename)
+            time.sleep(clargs.interval)
+
+        # Files being built are finished before stopping, so they don't
+        # leave partial outputs behind or stay in the inbox.
+        pool.close()
+        for in_filename in sorted(pending):
+            started, async_res = pending.pop(in_filename)
+            finishFile(in_filename, started, async_res, clargs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main():
+    """
+    Parse command line arguments. And call functions which do
+    the real work.
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('inbox',
+            help='Directory to watch for input text files.')
+
+    parser.add_argument('--done',
+            help='Directory built inputs are moved to. Defaults to done'
+            ' in the inbox.')
+
+    parser.add_argument('--failed',
+            help='Directory inputs which failed are moved to. Defaults to'
+            ' failed in the inbox.')
+
+    parser.add_argument('-j', '--jobs', type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes. Defaults to the number of'
+            ' cores.')
+
+    parser.add_argument('--interval', type=float, default=_POLL_INTERVAL,
+            help='Seconds between looks at the inbox. Defaults to %s.' %
+            _POLL_INTERVAL)
+
+    parser.add_argument('-q', '--quiet',
+            help="Don't print the output of each file, only a line on how"
+            " it fared.", action='store_true', default=False)
+
+    pIBO.addOutputArgs(parser)
+
+    clargs = parser.parse_args()
+    if clargs.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if not os.path.isdir(clargs.inbox):
+        sys.stderr.write('ERROR: No such directory: %s\n' % clargs.inbox)
+        sys.exit(2)
+    clargs.done = clargs.done or os.path.join(clargs.inbox, 'done')
+    clargs.failed = clargs.failed or os.path.join(clargs.inbox, 'failed')
+
+    watch(clargs)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()